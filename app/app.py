@@ -1,13 +1,39 @@
-from datetime import datetime
+import functools
 import json
 import logging
+import math
+import random
+import shutil
+import tempfile
+import threading
+import time
 
 import falcon
 
-from db_helpers import blaster_db, command_db
+from db_helpers import (
+    blaster_db,
+    command_db,
+    event_db,
+    learning_db,
+    metrics,
+    migrations,
+    profiling,
+)
 
 _LOGGER = logging.getLogger(__name__)
 
+STREAM_CHUNK_SIZE = 64 * 1024
+SPOOL_MAX_MEMORY = 1024 * 1024
+MAX_CACHED_RESPONSES = 256
+MAX_CACHED_BODY_SIZE = 1024 * 1024
+MAX_PAGE_SIZE = 1000
+
+# Bodies of the catalog endpoints keyed by URI, each with the ETag it was built
+# for. ETags are made of the catalog versions that every write bumps, so a body
+# is only rebuilt after the data behind it has changed.
+_response_cache = {}
+_response_cache_lock = threading.Lock()
+
 ## Generic helper functions
 
 
@@ -61,65 +87,505 @@ def get_command(target_name, command_name):
         )
 
 
+# Streams {"targets": [{"name": ..., "commands": [...]}, ...]} without building
+# the whole catalog in memory, flushing roughly every STREAM_CHUNK_SIZE bytes.
+# With a limit, a page of that many commands (or empty targets) is streamed
+# with the "next" cursor to pass as after for the following page.
+def stream_all_commands(fields=("name", "value"), limit=None, after=None):
+    chunk = ['{"targets": [']
+    chunk_size = 0
+    current_uid = None
+    last_row = None
+    next_after = None
+
+    rows = command_db.iter_targets_with_commands(
+        fields, None if limit is None else limit + 1, after
+    )
+    for count, (uid, target_name, command_uid, command) in enumerate(rows):
+        if count == limit:
+            next_after = "%d-%d" % last_row
+            break
+        last_row = (uid, command_uid)
+
+        if uid != current_uid:
+            if current_uid is not None:
+                chunk.append("]}, ")
+            chunk.append('{"name": ' + json.dumps(target_name) + ', "commands": [')
+            current_uid = uid
+            first_command = True
+
+        if command is not None:
+            if not first_command:
+                chunk.append(", ")
+            line = json.dumps(command)
+            chunk.append(line)
+            chunk_size += len(line)
+            first_command = False
+
+        if chunk_size >= STREAM_CHUNK_SIZE:
+            yield "".join(chunk).encode()
+            chunk = []
+            chunk_size = 0
+
+    if current_uid is not None:
+        chunk.append("]}")
+    chunk.append("]")
+    if limit is not None:
+        chunk.append(', "next": ' + json.dumps(next_after))
+    chunk.append("}")
+    yield "".join(chunk).encode()
+
+
+# Streams every Target and Command as NDJSON lines in the format accepted by
+# command_db.import_commands
+def stream_export():
+    chunk = []
+    chunk_size = 0
+
+    for _, target_name, _, command in command_db.iter_targets_with_commands(
+        command_db.COMMAND_FIELDS
+    ):
+        row = {"target": target_name}
+        if command is not None:
+            row.update(command)
+            chunk_size += len(command["value"])
+        chunk.append(json.dumps(row) + "\n")
+
+        if chunk_size >= STREAM_CHUNK_SIZE:
+            yield "".join(chunk).encode()
+            chunk = []
+            chunk_size = 0
+
+    if chunk:
+        yield "".join(chunk).encode()
+
+
+# Returns the limit and after params of a list request, see blaster_db.paginate
+def get_page_params(req):
+    limit = req.get_param_as_int("limit", min_value=1, max_value=MAX_PAGE_SIZE)
+    after = req.get_param_as_int("after")
+    return limit, after
+
+
+# Returns the command fields a list request asks for with fields=<f1>,<f2>
+def get_command_fields(req, default=command_db.COMMAND_FIELDS):
+    fields = req.get_param("fields")
+    if fields is None:
+        return default
+
+    fields = fields.split(",")
+    if not set(fields) <= set(command_db.COMMAND_FIELDS):
+        raise falcon.HTTPInvalidParam(
+            "Must be a comma separated list of "
+            + ", ".join(command_db.COMMAND_FIELDS)
+            + ".",
+            "fields",
+        )
+    return tuple(field for field in command_db.COMMAND_FIELDS if field in fields)
+
+
+# json.dumps, timed as the serialize span of the request's profile
+def dump_json(value):
+    start = time.monotonic()
+    body = json.dumps(value)
+    profiling.add_span(profiling.SERIALIZE, time.monotonic() - start)
+    return body
+
+
+# Serializes an (items, next_after) page as {name: items}, adding the cursor of
+# the next page if the request set a limit
+def page_body(name, page, limit):
+    items, next_after = page
+    body = {name: items}
+    if limit is not None:
+        body["next"] = next_after
+    return dump_json(body).encode()
+
+
+def catalog_etag():
+    return "c" + str(command_db.get_catalog_version())
+
+
+def blasters_etag():
+    return (
+        "b"
+        + str(blaster_db.get_blasters_version())
+        + "-"
+        + str(blaster_db.get_status_version())
+    )
+
+
+def is_not_modified(req, etag):
+    return any(tag == etag for tag in req.if_none_match or ())
+
+
+def get_cached_body(req, etag):
+    with _response_cache_lock:
+        entry = _response_cache.get(req.relative_uri)
+
+    hit = entry is not None and entry[0] == etag
+    metrics.count_cache_lookup("responses", hit)
+    return entry[1] if hit else None
+
+
+def cache_body(req, etag, body):
+    if len(body) > MAX_CACHED_BODY_SIZE:
+        return
+
+    with _response_cache_lock:
+        if len(_response_cache) >= MAX_CACHED_RESPONSES:
+            _response_cache.clear()
+        _response_cache[req.relative_uri] = (etag, body)
+
+
+# Answers with 304 if the client already has the current version, else with
+# the cached body or a new one from build(), which returns bytes
+def respond_cached(req, resp, etag, build):
+    if is_not_modified(req, etag):
+        resp.status = falcon.HTTP_304
+    else:
+        body = get_cached_body(req, etag)
+        if body is None:
+            body = build()
+            cache_body(req, etag, body)
+        resp.data = body
+    resp.etag = etag
+
+
+# Passes chunks through and caches the complete body once they have all been
+# sent, unless it turns out to be too large
+def stream_cached(req, etag, chunks):
+    body = []
+    size = 0
+
+    for chunk in chunks:
+        if body is not None:
+            size += len(chunk)
+            if size <= MAX_CACHED_BODY_SIZE:
+                body.append(chunk)
+            else:
+                body = None
+        yield chunk
+
+    if body is not None:
+        cache_body(req, etag, b"".join(body))
+
+
+# Sends once for all requests with the same Idempotency-Key header and, when
+# the command has a debounce window, once for repeats of request within it.
+# request identifies what is sent and succeeded tells whether the result of
+# send() was a success, see blaster_db.share_send.
+def send_once(req, command, request, send, succeeded=bool):
+    if command.debounce_ms:
+        send = functools.partial(
+            blaster_db.share_send,
+            request,
+            command.debounce_ms / 1000,
+            send,
+            succeeded=succeeded,
+        )
+
+    key = req.get_header("Idempotency-Key")
+    if key:
+        return blaster_db.share_send(
+            ("idempotency", key),
+            blaster_db.IDEMPOTENCY_TTL,
+            send,
+            request,
+            succeeded,
+        )
+    return send()
+
+
+# Formats events from event_db.iter_events as Server-Sent Events. The id lets
+# a reconnecting client resume with Last-Event-ID, and a comment is sent while
+# there are no events so proxies keep the connection open.
+def stream_events(events):
+    yield b"retry: 1000\n\n"
+
+    for event in events:
+        if event is None:
+            yield b": keepalive\n\n"
+        else:
+            yield (
+                "id: %d\nevent: %s\ndata: %s\n\n"
+                % (event["id"], event["type"], json.dumps(event))
+            ).encode()
+
+
+# Copies a request body into a temporary file, kept in memory up to
+# SPOOL_MAX_MEMORY bytes, so it can be read line by line once the client has
+# sent all of it rather than while a transaction waits on a slow upload
+def spool_body(stream):
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    shutil.copyfileobj(stream, spool, STREAM_CHUNK_SIZE)
+    spool.seek(0)
+    return spool
+
+
+# Error for a send the blaster didn't take: 503 while its circuit breaker
+# fails sends straight away, else 504
+def blaster_unavailable(blaster, attr, value):
+    description = (
+        "Blaster with attribute '" + attr + "' of value '" + value + "' is unavailable"
+    )
+    cooldown = blaster_db.get_breaker(blaster.mac_hex).cooldown_left()
+    if cooldown:
+        return falcon.HTTPServiceUnavailable(
+            description=description, retry_after=math.ceil(cooldown)
+        )
+    return falcon.HTTPGatewayTimeout(description=description)
+
+
+# Returns the steps of a {"steps": [...]} JSON body, or None without a body
+def get_body_steps(req):
+    media = req.get_media(default_when_empty=None)
+    if media is not None and not isinstance(media, dict):
+        raise falcon.HTTPBadRequest(description="Body must be a JSON object")
+    return (media or {}).get("steps")
+
+
+def get_macro(macro_name):
+    macro = command_db.get_macro(macro_name)
+
+    if macro:
+        return macro
+    else:
+        raise falcon.HTTPBadRequest(description="Macro '" + macro_name + "' not found")
+
+
+# Whether the server goes on with other requests while this one waits. A WSGI
+# server handling one request at a time per process, like gunicorn's default
+# sync worker, would stall them all. The ASGI app (whose requests have no WSGI
+# environ) runs responders on a thread pool.
+def can_block(req):
+    env = getattr(req, "env", None)
+    return env is None or bool(env.get("wsgi.multithread"))
+
+
+def get_learning_job(job_id):
+    job = learning_db.get_job(job_id)
+
+    if job:
+        return job
+    else:
+        raise falcon.HTTPNotFound(description="Learning job '" + job_id + "' not found")
+
+
 ## REST Server block
 
-## Middleware Class to open and close DB properly
-class MiddlewareDatabaseHandler(object):
+# NOTE: DB connections are opened lazily by peewee the first time a request
+# touches a DB and are then kept open and reused by the same thread, so each
+# request only pays for the DBs it actually uses.
+
+
+# Middleware recording the latency of every request by route template, so all
+# requests for e.g. /blasters/{attr}/{value} share one histogram. The async
+# variants are used by the ASGI app in asgi.py.
+class RequestMetricsMiddleware(object):
     def process_request(self, req, resp):
-        command_db.commands_db.connect()
-        command_db.Command.create_table(safe=True)
-        command_db.Target.create_table(safe=True)
+        req.context.start = time.monotonic()
 
-        blaster_db.blasters_db.connect()
-        blaster_db.Blaster.create_table(safe=True)
+    def process_response(self, req, resp, resource, req_succeeded):
+        metrics.REQUEST_LATENCY.labels(
+            req.method, req.uri_template or "unmatched", str(resp.status)[:3]
+        ).observe(time.monotonic() - req.context.start)
+
+    async def process_request_async(self, req, resp):
+        self.process_request(req, resp)
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        self.process_response(req, resp, resource, req_succeeded)
+
+
+# Middleware profiling every request while profiling is enabled (see
+# db_helpers/profiling.py). Responses get a Server-Timing header if
+# BROADLINK_SERVER_TIMING is set, or if the request asked for a profile with an
+# X-Profile: 1 header (allowed by BROADLINK_PROFILE_HEADER). Those requests and
+# a BROADLINK_PROFILE_SAMPLE_RATE fraction of all requests run under cProfile.
+# The async variants leave cProfile to asgi.py, which runs responders on other
+# threads than the middleware.
+class ProfilingMiddleware(object):
+    def start_profile(self, req):
+        req.context.profile_requested = (
+            profiling.PROFILE_HEADER and req.get_header("X-Profile") == "1"
+        )
+        sampled = random.random() < profiling.PROFILE_SAMPLE_RATE
+        return profiling.start_profile(
+            req.method, req.path, req.context.profile_requested or sampled
+        )
+
+    def finish_profile(self, req, resp):
+        server_timing = profiling.finish_profile(
+            req.context.profile, req.uri_template or "unmatched"
+        )
+        if profiling.SERVER_TIMING or req.context.profile_requested:
+            resp.set_header("Server-Timing", server_timing)
+
+    def process_request(self, req, resp):
+        req.context.profile = self.start_profile(req)
+        if req.context.profile.profiler:
+            req.context.profile.profiler.enable()
 
     def process_response(self, req, resp, resource, req_succeeded):
-        command_db.commands_db.close()
-        blaster_db.blasters_db.close()
+        if req.context.profile.profiler:
+            req.context.profile.profiler.disable()
+        self.finish_profile(req, resp)
+
+    async def process_request_async(self, req, resp):
+        req.context.profile = self.start_profile(req)
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        self.finish_profile(req, resp)
+
+
+# Resource to export metrics in the Prometheus text format
+# /metrics
+# GET returns metrics aggregated across all workers
+
+
+class MetricsRESTResource(object):
+    def on_get(self, req, resp):
+        resp.data, resp.content_type = metrics.render()
+
+
+# Resource to subscribe to changes instead of polling
+# /events
+# GET streams Server-Sent Events for Blaster status changes, Blasters found or moved by discovery, learning job updates and catalog changes, types=<t1>,<t2> picks the event types, resumes after Last-Event-ID (or after=<id>), ends after timeout=<seconds>
+
+
+class EventsRESTResource(object):
+    def on_get(self, req, resp):
+        after = req.get_header("Last-Event-ID") or req.get_param("after")
+        if after is not None:
+            try:
+                after = int(after)
+            except ValueError:
+                raise falcon.HTTPBadRequest(
+                    description="Last-Event-ID and after must be event ids"
+                )
+
+        types = req.get_param("types")
+        if types is not None:
+            types = types.split(",")
+            if not set(types) <= set(event_db.EVENT_TYPES):
+                raise falcon.HTTPInvalidParam(
+                    "Must be a comma separated list of "
+                    + ", ".join(event_db.EVENT_TYPES)
+                    + ".",
+                    "types",
+                )
+
+        timeout = min(
+            req.get_param_as_float(
+                "timeout", min_value=0, default=event_db.EVENT_STREAM_TIMEOUT
+            ),
+            event_db.EVENT_STREAM_TIMEOUT,
+        )
+
+        if not can_block(req):
+            raise falcon.HTTPServiceUnavailable(
+                description="Event streams need a threaded server, run gunicorn with --threads or use SERVER_MODE=asgi"
+            )
+
+        resp.content_type = "text/event-stream"
+        resp.cache_control = ["no-cache"]
+        resp.stream = stream_events(event_db.iter_events(after, types, timeout))
+
+
+# Resource to check whether the app has finished starting up
+# /ready
+# GET returns 200 once initial Blaster discovery has completed, 503 before then
+
+
+class ReadyRESTResource(object):
+    def on_get(self, req, resp):
+        ready = blaster_db.initial_discovery_done()
+        if not ready:
+            resp.status = falcon.HTTP_503
+        resp.body = dump_json({"ready": ready, "discovery_complete": ready})
 
 
 # Resource to discover devices
 # /discoverblasters
-# GET adds all newly discovered devices to DB and returns number of new RM devices found, required when adding a new device to the network
+# GET returns the results of the latest background discovery run, wait=<seconds> runs discovery now and waits for it
 # NOTE: Only retains devices of type RM
 
 
 class DiscoverRESTResource(object):
     def on_get(self, req, resp):
-        resp.body = json.dumps(blaster_db.get_new_blasters())
+        wait = min(
+            req.get_param_as_float("wait", default=0),
+            2 * blaster_db.DISCOVERY_TIMEOUT,
+        )
+        results, fresh = blaster_db.get_discovery_results(wait=wait)
+        if not fresh:
+            # Still running, so these are the previous results
+            resp.status = falcon.HTTP_202
+
+        resp.body = dump_json(
+            results
+            or {
+                "new_devices": 0,
+                "moved_devices": 0,
+                "devices_found": 0,
+                "finished": None,
+            }
+        )
 
 
 # Resource to interact with all discovered Blasters
 # /blasters
-# GET returns Blasters list
-# POST sends command to all Blasters
+# GET returns Blasters list with last known status (or 304 for a matching If-None-Match), fresh=1 checks every Blaster first, limit=<n> returns a page of n Blasters with the "next" cursor to pass as after=<cursor>
+# POST sends command to all Blasters in parallel and returns per-Blaster results, requests with the same Idempotency-Key header (or within the command's debounce_ms) share one send
 
 
 class BlastersRESTResource(object):
     def on_get(self, req, resp):
-        resp.body = json.dumps({"blasters": blaster_db.get_all_blasters_as_dict()})
+        limit, after = get_page_params(req)
+
+        if req.get_param_as_bool("fresh", default=False):
+            resp.data = page_body(
+                "blasters", blaster_db.get_blasters_page(limit, after, True), limit
+            )
+            return
+
+        respond_cached(
+            req,
+            resp,
+            blasters_etag(),
+            lambda: page_body(
+                "blasters", blaster_db.get_blasters_page(limit, after), limit
+            ),
+        )
 
     def on_post(self, req, resp):
         target_name = req.get_param("target_name", required=True)
         command_name = req.get_param("command_name", required=True)
 
-        target = command_db.get_target(target_name)
-
-        if target:
-            command = target.get_command(command_name)
+        command = command_db.get_cached_command(target_name, command_name)
 
-            if command:
-                blaster_db.send_command_to_all_blasters(command)
-            else:
-                raise falcon.HTTPInvalidParam(
-                    "Command of '"
-                    + command_name
-                    + "' does not exist for Target '"
-                    + target_name
-                    + "'.",
-                    "command_name",
+        if command:
+            try:
+                results = send_once(
+                    req,
+                    command,
+                    ("broadcast", command.target_name, command.name),
+                    lambda: blaster_db.send_command_to_all_blasters(command),
+                    blaster_db.broadcast_succeeded,
                 )
-
+            except ValueError as err:
+                raise falcon.HTTPBadRequest(description=str(err))
+            resp.body = dump_json({"blasters": results})
+        elif command_db.get_target(target_name):
+            raise falcon.HTTPInvalidParam(
+                "Command of '"
+                + command_name
+                + "' does not exist for Target '"
+                + target_name
+                + "'.",
+                "command_name",
+            )
         else:
             raise falcon.HTTPInvalidParam(
                 "Target of '" + target_name + "' does not exist.", "target_name"
@@ -128,40 +594,97 @@ class BlastersRESTResource(object):
 
 # Resource to return all Targets
 # /targets
-# GET returns all Targets
+# GET returns all Targets, or 304 if If-None-Match has the current ETag, limit=<n> returns a page of n Targets with the "next" cursor to pass as after=<cursor>
 
 
 class TargetsRESTResource(object):
     def on_get(self, req, resp):
-        resp.body = json.dumps({"targets": command_db.get_all_targets_as_dict()})
+        limit, after = get_page_params(req)
+
+        respond_cached(
+            req,
+            resp,
+            catalog_etag(),
+            lambda: page_body(
+                "targets", command_db.get_targets_page(limit, after), limit
+            ),
+        )
 
 
 # Resource to return all Commands
 # /commands
-# GET returns all Commands
+# GET returns all Commands grouped by Target, streamed as chunked JSON, or 304 if If-None-Match has the current ETag, fields=<f1>,<f2> picks the Command fields (name and value by default), limit=<n> returns a page of n Commands with the "next" cursor to pass as after=<cursor>
 
 
 class CommandsRESTResource(object):
     def on_get(self, req, resp):
-        targets = command_db.get_all_targets()
-        targets_to_ret = command_db.get_all_targets_as_dict()
-        for x in range(len(targets)):
-            targets_to_ret[x]["commands"] = targets[x].get_all_commands_as_dict()
+        fields = get_command_fields(req, default=("name", "value"))
+        limit = req.get_param_as_int("limit", min_value=1, max_value=MAX_PAGE_SIZE)
+        after = req.get_param("after")
+        if after is not None:
+            try:
+                target_uid, command_uid = (int(uid) for uid in after.split("-"))
+            except ValueError:
+                raise falcon.HTTPInvalidParam(
+                    "Must be the next value of an earlier page.", "after"
+                )
+            after = (target_uid, command_uid)
+
+        etag = catalog_etag()
+        resp.etag = etag
+
+        if is_not_modified(req, etag):
+            resp.status = falcon.HTTP_304
+            return
+
+        body = get_cached_body(req, etag)
+        if body is not None:
+            resp.data = body
+        else:
+            resp.stream = stream_cached(
+                req, etag, stream_all_commands(fields, limit, after)
+            )
+
+
+# Resource to export all Targets and Commands
+# /commands/export
+# GET returns one NDJSON line per Command ({"target", "name", "value"}) or empty Target ({"target"})
+
+
+class CommandsExportRESTResource(object):
+    def on_get(self, req, resp):
+        resp.content_type = "application/x-ndjson"
+        resp.stream = stream_export()
 
-        resp.body = json.dumps({"targets": targets_to_ret})
+
+# Resource to import Targets and Commands
+# /commands/import
+# POST creates/updates Targets and Commands from an NDJSON body in the export format, dry_run=1 only validates
+
+
+class CommandsImportRESTResource(object):
+    def on_post(self, req, resp):
+        dry_run = req.get_param_as_bool("dry_run", default=False)
+        with spool_body(req.bounded_stream) as lines:
+            result = command_db.import_commands(lines, dry_run=dry_run)
+        result["dry_run"] = dry_run
+        resp.body = dump_json(result)
 
 
 # Resource to interact with a specific Blaster
 # /blasters/{attr}/{value}
-# GET returns Blaster info
+# GET returns Blaster info with last known status, fresh=1 checks the Blaster first
 # PUT creates/updates Blaster name
-# POST sends command to Blaster
+# POST sends command to Blaster, repeat=<n> or hold_ms=<ms> repeat it (on the device unless gap_ms=<ms> is set), requests with the same Idempotency-Key header (or within the command's debounce_ms) share one send
 # DELETE deletes Blaster
 
 
 class BlasterRESTResource(object):
     def on_get(self, req, resp, attr, value):
-        resp.body = json.dumps(get_blaster(attr, value).to_dict())
+        blaster = get_blaster(attr, value)
+        if req.get_param_as_bool("fresh", default=False):
+            blaster.probe()
+        resp.body = dump_json(blaster.to_dict())
 
     def on_put(self, req, resp, attr, value):
         new_name = req.get_param("new_name", required=True)
@@ -174,23 +697,50 @@ class BlasterRESTResource(object):
     def on_post(self, req, resp, attr, value):
         target_name = req.get_param("target_name", required=True)
         command_name = req.get_param("command_name", required=True)
+        repeat = req.get_param_as_int(
+            "repeat", min_value=1, max_value=blaster_db.MAX_SEND_REPEAT, default=1
+        )
+        gap_ms = req.get_param_as_int(
+            "gap_ms", min_value=0, max_value=blaster_db.MAX_SEND_GAP_MS, default=0
+        )
+        hold_ms = req.get_param_as_int(
+            "hold_ms", min_value=0, max_value=blaster_db.MAX_HOLD_MS, default=0
+        )
 
         blaster = get_blaster(attr, value)
-        target = command_db.get_target(target_name)
-
-        if target:
-            command = target.get_command(command_name)
-
-            if command:
-                blaster.send_command(command)
-            else:
-                raise falcon.HTTPBadRequest(
-                    description="Command '"
-                    + command_name
-                    + "' not found for Target '"
-                    + target_name
-                    + "'"
+        command = command_db.get_cached_command(target_name, command_name)
+
+        if command:
+            request = (
+                "send",
+                blaster.mac_hex,
+                command.target_name,
+                command.name,
+                repeat,
+                gap_ms,
+                hold_ms,
+            )
+            try:
+                sent = send_once(
+                    req,
+                    command,
+                    request,
+                    lambda: blaster.send_command(
+                        command, repeat=repeat, gap_ms=gap_ms, hold_ms=hold_ms
+                    ),
                 )
+            except ValueError as err:
+                raise falcon.HTTPBadRequest(description=str(err))
+            if not sent:
+                raise blaster_unavailable(blaster, attr, value)
+        elif command_db.get_target(target_name):
+            raise falcon.HTTPBadRequest(
+                description="Command '"
+                + command_name
+                + "' not found for Target '"
+                + target_name
+                + "'"
+            )
         else:
             raise falcon.HTTPBadRequest(
                 description="Target '" + target_name + "' not found"
@@ -202,12 +752,17 @@ class BlasterRESTResource(object):
 
 # Resource to get status of a specific Blaster
 # /blasters/{attr}/{value}/status
-# GET returns Blaster status
+# GET returns last known Blaster status, fresh=1 (or no known status) checks the Blaster
 
 
 class BlasterStatusRESTResource(object):
     def on_get(self, req, resp, attr, value):
-        if not get_blaster(attr, value).available():
+        blaster = get_blaster(attr, value)
+
+        if req.get_param_as_bool("fresh", default=False) or blaster.available is None:
+            blaster.probe()
+
+        if not blaster.available:
             raise falcon.HTTPGatewayTimeout(
                 "Blaster with attribute '"
                 + attr
@@ -216,6 +771,88 @@ class BlasterStatusRESTResource(object):
                 + "' did not respond to availability check within timeout window"
             )
 
+        resp.body = dump_json(
+            {"available": True, "last_seen": blaster.last_seen.isoformat()}
+        )
+
+
+# Resource to send a sequence of Commands through a specific Blaster
+# /blasters/{attr}/{value}/sequence
+# POST sends the steps of macro macro_name, or the JSON body's steps, over one device session and returns when each step started
+
+
+class BlasterSequenceRESTResource(object):
+    def on_post(self, req, resp, attr, value):
+        macro_name = req.get_param("macro_name")
+
+        if macro_name:
+            steps = get_macro(macro_name).to_dict()["steps"]
+        else:
+            steps = get_body_steps(req)
+
+        blaster = get_blaster(attr, value)
+        try:
+            resolved_steps = command_db.resolve_steps(steps)
+        except ValueError as err:
+            raise falcon.HTTPBadRequest(description=str(err))
+
+        offsets = blaster.send_sequence(resolved_steps)
+        if offsets is False:
+            raise blaster_unavailable(blaster, attr, value)
+
+        resp.body = dump_json(
+            {
+                "steps": [
+                    {
+                        "target": command.target_name,
+                        "command": command.name,
+                        "repeat": repeat,
+                        "delay_ms": delay_ms,
+                        "offset_ms": offset_ms,
+                    }
+                    for (command, repeat, delay_ms), offset_ms in zip(
+                        resolved_steps, offsets
+                    )
+                ]
+            }
+        )
+
+
+# Resource to return all Macros
+# /macros
+# GET returns all Macros
+
+
+class MacrosRESTResource(object):
+    def on_get(self, req, resp):
+        resp.body = dump_json({"macros": command_db.get_all_macros_as_dict()})
+
+
+# Resource to interact with a specific Macro
+# /macros/{macro_name}
+# GET returns Macro steps
+# PUT creates/updates Macro from the JSON body's steps
+# DELETE deletes Macro
+
+
+class MacroRESTResource(object):
+    def on_get(self, req, resp, macro_name):
+        resp.body = dump_json(get_macro(macro_name).to_dict())
+
+    def on_put(self, req, resp, macro_name):
+        steps = get_body_steps(req)
+
+        try:
+            command_db.put_macro(macro_name, command_db.normalize_steps(steps))
+        except ValueError as err:
+            raise falcon.HTTPBadRequest(description=str(err))
+
+    def on_delete(self, req, resp, macro_name):
+        if not command_db.delete_macro(macro_name):
+            raise falcon.HTTPBadRequest(
+                description="Macro '" + macro_name + "' not found"
+            )
+
 
 # Resource to interact with a specific Target
 # /targets/{target_name}
@@ -248,42 +885,54 @@ class TargetRESTResource(object):
 
 # Resource to get Target specific Commands
 # /targets/{target_name}/commands
-# GET returns all Commands for Target 'target_name'
+# GET returns all Commands for Target 'target_name', or 304 if If-None-Match has the current ETag, fields=<f1>,<f2> picks the Command fields, limit=<n> returns a page of n Commands with the "next" cursor to pass as after=<cursor>
 
 
 class TargetCommandsRESTResource(object):
     def on_get(self, req, resp, target_name):
-        target = command_db.get_target(target_name)
+        fields = get_command_fields(req)
+        limit, after = get_page_params(req)
+        # Looked up first, since the catalog ETag also matches for missing targets
+        target = get_target(target_name)
 
-        if target:
-            resp.body = json.dumps({"commands": target.get_all_commands_as_dict()})
-        else:
-            raise falcon.HTTPBadRequest(
-                description="Target '" + target_name + "' not found"
-            )
+        respond_cached(
+            req,
+            resp,
+            catalog_etag(),
+            lambda: page_body(
+                "commands", target.get_commands_page(fields, limit, after), limit
+            ),
+        )
 
 
 # Resource to interact with Target specific Command
 # /targets/{target_name}/commands/{command_name}
 # GET returns command value
-# PUT creates/updates command value - uses "value" param if exists otherwise learns command from blaster with blaster_attr/blaster_value pair
-# PATCH updates command name to new_name
+# PUT creates/updates command value - uses "value" param if exists (and debounce_ms if given) otherwise starts a learning job on blaster with blaster_attr/blaster_value pair
+# PATCH updates command name to new_name and/or its debounce window to debounce_ms
 # DELETE deletes command
 
 
 class TargetCommandRESTResource(object):
     def on_get(self, req, resp, target_name, command_name):
-        resp.body = json.dumps(get_command(target_name, command_name).to_dict())
+        resp.body = dump_json(get_command(target_name, command_name).to_dict())
 
     def on_put(self, req, resp, target_name, command_name):
         value = req.get_param("value")
         blaster_attr = req.get_param("blaster_attr")
         blaster_value = req.get_param("blaster_value")
+        debounce_ms = req.get_param_as_int(
+            "debounce_ms", min_value=0, max_value=command_db.MAX_DEBOUNCE_MS
+        )
 
         target = get_target(target_name)
 
         if value:
-            target.put_command(command_name, value)
+            try:
+                command_db.decode_value(value)
+            except ValueError as err:
+                raise falcon.HTTPInvalidParam(str(err), "value")
+            target.put_command(command_name, value, debounce_ms)
         else:
             if blaster_attr is None or blaster_value is None:
                 raise falcon.HTTPBadRequest(
@@ -291,18 +940,33 @@ class TargetCommandRESTResource(object):
                 )
             else:
                 blaster = get_blaster(blaster_attr, blaster_value)
-                value = blaster.get_command()
-                if value:
-                    target.put_command(command_name, value)
+                job = learning_db.start_job(blaster, target.name, command_name)
+                if job:
+                    resp.status = falcon.HTTP_202
+                    resp.location = "/learningjobs/" + job.job_id
+                    resp.body = dump_json(job.to_dict())
                 else:
-                    raise falcon.HTTPGatewayTimeout(
-                        description="Blaster did not receive any IR signals to learn"
+                    raise falcon.HTTPConflict(
+                        description="Blaster is already learning a command"
                     )
 
     def on_patch(self, req, resp, target_name, command_name):
-        new_name = req.get_param("new_name", required=True)
+        new_name = req.get_param("new_name")
+        debounce_ms = req.get_param_as_int(
+            "debounce_ms", min_value=0, max_value=command_db.MAX_DEBOUNCE_MS
+        )
+        if new_name is None and debounce_ms is None:
+            raise falcon.HTTPBadRequest(
+                description="Specify new_name and/or debounce_ms to update"
+            )
+
+        command = get_command(target_name, command_name)
+        if debounce_ms is not None:
+            command.debounce_ms = debounce_ms
 
-        if not get_command(target_name, new_name).update_name(new_name):
+        if new_name is None:
+            command.save()
+        elif not command.update_name(new_name):
             raise falcon.HTTPConflict(
                 description="Command '"
                 + new_name
@@ -315,65 +979,102 @@ class TargetCommandRESTResource(object):
         get_command(target_name, command_name).delete_instance()
 
 
+# Resource to interact with a learning job
+# /learningjobs/{job_id}
+# GET returns job status and learned value, wait=<seconds> waits for the job to finish first
+# DELETE cancels job
+
+
+class LearningJobRESTResource(object):
+    def on_get(self, req, resp, job_id):
+        job = get_learning_job(job_id)
+        wait = min(
+            req.get_param_as_float("wait", default=0), blaster_db.LEARNING_TIMEOUT
+        )
+        if not can_block(req):
+            # Waiting would hold up every other request
+            wait = 0
+        deadline = time.monotonic() + wait
+
+        while not job.done and time.monotonic() < deadline:
+            time.sleep(0.25)
+            job = get_learning_job(job_id)
+
+        resp.body = dump_json(job.to_dict())
+
+    def on_delete(self, req, resp, job_id):
+        if not get_learning_job(job_id).cancel():
+            raise falcon.HTTPConflict(
+                description="Learning job '" + job_id + "' has already finished"
+            )
+
+
+# Middleware of both apps. Profiling comes first so it covers the other
+# middleware, and is left out unless enabled so it costs nothing.
+middleware = [RequestMetricsMiddleware()]
+if profiling.ENABLED:
+    middleware.insert(0, ProfilingMiddleware())
+
 # falcon.API instances are callable WSGI apps
-app = falcon.API(middleware=MiddlewareDatabaseHandler())
+app = falcon.API(middleware=middleware)
 app.req_options.auto_parse_form_urlencoded = True
 
 # Resources are represented by long-lived class instances
+ready = ReadyRESTResource()
+metrics_resource = MetricsRESTResource()
+events = EventsRESTResource()
 discover = DiscoverRESTResource()
 blasters = BlastersRESTResource()
 blaster = BlasterRESTResource()
 blaster_status = BlasterStatusRESTResource()
+blaster_sequence = BlasterSequenceRESTResource()
 targets = TargetsRESTResource()
 target = TargetRESTResource()
 target_commands = TargetCommandsRESTResource()
 target_command = TargetCommandRESTResource()
 commands = CommandsRESTResource()
-
-# All supported routes.
-app.add_route("/discoverblasters", discover)
-app.add_route("/blasters", blasters)
-app.add_route("/targets", targets)
-app.add_route("/commands", commands)
-app.add_route("/blasters/{attr}/{value}", blaster)
-app.add_route("/blasters/{attr}/{value}/status", blaster_status)
-app.add_route("/targets/{target_name}/commands/{command_name}", target_command)
-app.add_route("/targets/{target_name}/commands", target_commands)
-app.add_route("/targets/{target_name}", target)
-
-# Initialize blasters DB by discovering blasters
-blaster_db.blasters_db.connect()
-blaster_db.Blaster.create_table(safe=True)
-blaster_db.get_new_blasters(timeout=3)
+commands_export = CommandsExportRESTResource()
+commands_import = CommandsImportRESTResource()
+learning_job = LearningJobRESTResource()
+macros = MacrosRESTResource()
+macro = MacroRESTResource()
+
+# All supported routes, also served by the ASGI app in asgi.py
+routes = [
+    ("/ready", ready),
+    ("/metrics", metrics_resource),
+    ("/events", events),
+    ("/discoverblasters", discover),
+    ("/blasters", blasters),
+    ("/targets", targets),
+    ("/commands", commands),
+    ("/commands/export", commands_export),
+    ("/commands/import", commands_import),
+    ("/blasters/{attr}/{value}", blaster),
+    ("/blasters/{attr}/{value}/status", blaster_status),
+    ("/blasters/{attr}/{value}/sequence", blaster_sequence),
+    ("/targets/{target_name}/commands/{command_name}", target_command),
+    ("/targets/{target_name}/commands", target_commands),
+    ("/targets/{target_name}", target),
+    ("/learningjobs/{job_id}", learning_job),
+    ("/macros", macros),
+    ("/macros/{macro_name}", macro),
+]
+
+for uri, resource in routes:
+    app.add_route(uri, resource)
+
+## Startup
+# Every step is idempotent and returns quickly once done, so each worker runs them
+
+# Create DB tables and apply pending migrations
+migrations.init_databases()
 blaster_db.blasters_db.close()
-
-### Data migrations
-
-### Command DB Migrations
-
-command_db.commands_db.connect()
-if not command_db.Command.table_exists():
-    command_db.Command.create_table(safe=True)
-
-# Migrate from hex to base64 for IR values
-if not command_db.Encoding.table_exists():
-    for command in command_db.Command.select():
-        try:
-            _bytes = blaster_db.dec_hex(command.value)
-            command.value = blaster_db.enc_b64(_bytes)
-            command.save()
-        except ValueError:
-            command_db.commands_db.close()
-            break
-
-    command_db.Encoding.create_table(safe=True)
-    command_db.Encoding.create(encoding="base64", active_since=datetime.utcnow())
-
-if not command_db.commands_db.is_closed():
-    command_db.commands_db.close()
-
-### Blaster DB Migrations
-
-# blaster_db.blasters_db.connect()
-
-# blaster_db.blasters_db.close()
+command_db.commands_db.close()
+
+# Keep discovering blasters and checking their status in the background, so
+# the app can serve requests straight away and notices blasters that move.
+# With a device broker, the broker checks their status instead.
+blaster_db.start_discovery(initial_timeout=3)
+if not blaster_db.BROKER_SOCKET:
+    blaster_db.start_status_monitor()
@@ -0,0 +1,136 @@
+"""ASGI serving mode for the Broadlink RM REST Server.
+
+Serves the same resources as app.py from a falcon.asgi.App, e.g.
+`uvicorn asgi:app`. Responders stay synchronous and run on a bounded thread
+pool, so blocking Broadlink and SQLite calls never stall the event loop and
+many sends and status checks can be in flight in a single process.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial
+import io
+import json
+import os
+
+from db_helpers import profiling
+import falcon
+import falcon.asgi
+from falcon.uri import parse_query_string
+
+import app as wsgi_app
+
+ASGI_THREADS = int(os.environ.get("BROADLINK_ASGI_THREADS", "100"))
+
+# Number of body chunks a streamed response may buffer ahead of the client
+STREAM_QUEUE_SIZE = 4
+
+_UNSET = object()
+
+_executor = ThreadPoolExecutor(
+    max_workers=ASGI_THREADS, thread_name_prefix="asgi-responder"
+)
+
+
+class SyncRequest(object):
+    # Presents an ASGI request to a WSGI responder by serving the already read
+    # body through the synchronous media and stream interfaces
+
+    def __init__(self, req, body):
+        self._req = req
+        self._body = body
+        self.bounded_stream = io.BytesIO(body)
+
+    def __getattr__(self, name):
+        return getattr(self._req, name)
+
+    def get_media(self, default_when_empty=_UNSET):
+        if not self._body:
+            if default_when_empty is _UNSET:
+                raise falcon.MediaNotFoundError("JSON")
+            return default_when_empty
+        try:
+            return json.loads(self._body)
+        except ValueError:
+            raise falcon.MediaMalformedError("JSON")
+
+    @property
+    def media(self):
+        return self.get_media()
+
+
+async def _stream_from_thread(iterable):
+    # Iterates a synchronous body on a single pool thread, since DB cursors
+    # must stay on the thread that opened them, and hands chunks to the loop
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    done = object()
+    stopped = False
+
+    def produce():
+        try:
+            for chunk in iterable:
+                if stopped:
+                    break
+                asyncio.run_coroutine_threadsafe(queue.put(chunk), loop).result()
+        finally:
+            asyncio.run_coroutine_threadsafe(queue.put(done), loop).result()
+
+    producer = loop.run_in_executor(_executor, produce)
+    chunk = None
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        # If the client went away, drain the queue so the producer can stop
+        stopped = True
+        while chunk is not done:
+            chunk = await queue.get()
+        await producer
+
+
+def _wrap_responder(responder):
+    async def on_request(self, req, resp, **params):
+        body = await req.stream.read()
+
+        if req.content_type and req.content_type.startswith(falcon.MEDIA_URLENCODED):
+            req.params.update(parse_query_string(body.decode(), keep_blank=False))
+
+        # The responder runs in a copy of the request's context, so it sees
+        # the request's profile
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            _executor,
+            partial(
+                copy_context().run,
+                profiling.call_profiled,
+                responder,
+                SyncRequest(req, body),
+                resp,
+                **params,
+            ),
+        )
+
+        if resp.stream is not None and not hasattr(resp.stream, "__aiter__"):
+            resp.stream = _stream_from_thread(resp.stream)
+
+    return on_request
+
+
+def async_resource(resource):
+    responders = {
+        name: _wrap_responder(getattr(resource, name))
+        for name in dir(resource)
+        if name.startswith("on_")
+    }
+    return type("Async" + type(resource).__name__, (object,), responders)()
+
+
+app = falcon.asgi.App(middleware=wsgi_app.middleware)
+
+for uri, resource in wsgi_app.routes:
+    app.add_route(uri, async_resource(resource))
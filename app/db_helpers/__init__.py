@@ -1 +1,11 @@
-__all__ = ["blaster_db", "command_db"]
+__all__ = [
+    "blaster_db",
+    "command_db",
+    "device_broker",
+    "event_db",
+    "learning_db",
+    "metrics",
+    "migrations",
+    "profiling",
+    "sqlite_config",
+]
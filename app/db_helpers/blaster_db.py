@@ -1,19 +1,107 @@
+import base64
 import codecs
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextvars import copy_context
+from datetime import datetime
+import json
 from logging import getLogger
+import math
 import os
-from time import sleep
+import socket
+from threading import Condition, Event, Lock, Thread
+from time import monotonic, sleep, time
 
 import broadlink
-from peewee import AutoField, IntegerField, Model, SqliteDatabase, TextField
+from peewee import (
+    AutoField,
+    BooleanField,
+    DateTimeField,
+    FloatField,
+    IntegerField,
+    Model,
+    TextField,
+)
+
+from .event_db import BLASTER_FOUND, BLASTER_MOVED, BLASTER_STATUS, publish_event
+from .metrics import (
+    DEVICE_AUTH_FAILURES,
+    DEVICE_AUTH_LATENCY,
+    DEVICE_BREAKER_TRIPS,
+    DEVICE_SEND_FAILURES,
+    DEVICE_SEND_LATENCY,
+    DISCOVERY_DEVICES,
+    DISCOVERY_LATENCY,
+    TimedSqliteDatabase,
+    count_cache_lookup,
+)
+from .profiling import AUTH, DEVICE, add_span
+from .sqlite_config import SQLITE_OPTIONS
 
 STATUS_TIMEOUT = float(os.environ.get("BROADLINK_STATUS_TIMEOUT", "1"))
+STATUS_INTERVAL = float(os.environ.get("BROADLINK_STATUS_INTERVAL", "30"))
 DISCOVERY_TIMEOUT = float(os.environ.get("BROADLINK_DISCOVERY_TIMEOUT", "5"))
+DISCOVERY_ADDRESS = os.environ.get("BROADLINK_DISCOVERY_ADDRESS", "255.255.255.255")
+DISCOVERY_PORT = int(os.environ.get("BROADLINK_DISCOVERY_PORT", "80"))
+DISCOVERY_INTERVAL = float(os.environ.get("BROADLINK_DISCOVERY_INTERVAL", "60"))
+LEARNING_TIMEOUT = float(os.environ.get("BROADLINK_LEARNING_TIMEOUT", "12"))
+LEARNING_POLL_INTERVAL = 1
+BROADCAST_TIMEOUT = float(os.environ.get("BROADLINK_BROADCAST_TIMEOUT", "10"))
+DEVICE_TTL = float(os.environ.get("BROADLINK_DEVICE_TTL", "300"))
+BROKER_SOCKET = os.environ.get("BROADLINK_BROKER_SOCKET")
+BROKER_TIMEOUT = float(os.environ.get("BROADLINK_BROKER_TIMEOUT", "30"))
+MAX_SEND_REPEAT = 100
+MAX_SEND_GAP_MS = 10000
+MAX_HOLD_MS = 10000
+IDEMPOTENCY_TTL = float(os.environ.get("BROADLINK_IDEMPOTENCY_TTL", "60"))
+# Longest a shared send may stay in flight before another request takes it
+# over, e.g. because the worker sending it died
+SHARED_SEND_TIMEOUT = 60
+SHARED_SEND_POLL_INTERVAL = 0.05
+DEVICE_TIMEOUT = float(os.environ.get("BROADLINK_DEVICE_TIMEOUT", "5"))
+BREAKER_FAILURES = int(os.environ.get("BROADLINK_BREAKER_FAILURES", "3"))
+BREAKER_COOLDOWN = float(os.environ.get("BROADLINK_BREAKER_COOLDOWN", "30"))
+
+# broadlink resends a request every second until the timeout runs out, so this
+# leaves room for one resend however fast the blaster usually answers
+MIN_DEVICE_TIMEOUT = 2
+
+# First byte of Broadlink IR, 433MHz RF and 315MHz RF packets. The second byte
+# tells the device how many more times to send the frame, and each timing
+# value in the packet is in units of 269/8192 ms.
+REPEATABLE_PACKET_TYPES = (0x26, 0xB2, 0xD7)
+PACKET_TICK_MS = 269 / 8192
 
 _LOGGER = getLogger(__name__)
 
 blasters_db_path = "data/blasters.db"
 
-blasters_db = SqliteDatabase(blasters_db_path)
+blasters_db = TimedSqliteDatabase(blasters_db_path, **SQLITE_OPTIONS)
+
+# Authenticated device handles shared by all requests in this process, keyed by
+# mac_hex. Each entry is a (device, authenticated_at) tuple.
+_device_pool = {}
+_device_pool_lock = Lock()
+
+_status_monitor = None
+
+# Results of the latest discovery run. Runs are counted as they start and
+# finish so a caller can wait for a run that started after its request, and
+# _discovery_condition is notified whenever one finishes.
+_discovery_results = None
+_discovery_started = 0
+_discovery_finished = 0
+_discovery_condition = Condition()
+_discovery_requested = Event()
+_discovery_loop = None
+
+# When this process last purged expired shared sends (see _claim_send), which
+# it does at most once a second
+_shared_sends_purged = 0
+
+# Circuit breaker and round trip times of each blaster keyed by mac_hex (see
+# DeviceBreaker)
+_breakers = {}
+_breakers_lock = Lock()
 
 #### Blaster DB classes and functions
 
@@ -23,6 +111,26 @@ class BaseBlastersModel(Model):
         database = blasters_db
 
 
+# Single row counting changes to the Blaster table, bumped by every write
+class BlasterVersion(BaseBlastersModel):
+    version = IntegerField(default=0)
+
+
+# Last known availability of each blaster, kept up to date by the status
+# monitor and by every connection attempt of any worker. last_seen is when the
+# blaster last responded.
+class BlasterStatus(BaseBlastersModel):
+    mac_hex = TextField(primary_key=True)
+    available = BooleanField(null=True)
+    last_seen = DateTimeField(null=True)
+
+
+# Single row counting changes to the BlasterStatus table, so responses built
+# from it can be cached
+class StatusVersion(BaseBlastersModel):
+    version = IntegerField(default=0)
+
+
 class Blaster(BaseBlastersModel):
     uid = AutoField()
     ip = TextField()
@@ -34,35 +142,86 @@ class Blaster(BaseBlastersModel):
 
     @property
     def available(self):
-        return self.device is not None
+        return get_cached_status(self.mac_hex)[0]
+
+    @property
+    def last_seen(self):
+        return get_cached_status(self.mac_hex)[1]
 
     @property
     def device(self):
+        if not get_breaker(self.mac_hex).allow():
+            return None
+        device = get_pooled_device(self.mac_hex, (self.ip, self.port))
+        if device:
+            return device
+        return self.connect(check_breaker=False)
+
+    # Authenticates a new device handle and stores it in the device pool.
+    # Returns None straight away while the blaster's circuit breaker is open,
+    # unless check_breaker is False.
+    def connect(self, timeout=None, check_breaker=True):
+        breaker = get_breaker(self.mac_hex)
+        if check_breaker and not breaker.allow():
+            _LOGGER.debug("Circuit breaker of device %s is open", self.mac)
+            return None
+
         device = broadlink.rm(
             host=(self.ip, self.port), mac=dec_hex(self.mac_hex), devtype=self.devtype
         )
+        device.timeout = breaker.timeout() if timeout is None else timeout
+
+        start = monotonic()
         try:
             device.auth()
         except broadlink.exceptions.NetworkTimeoutError:
+            add_span(AUTH, monotonic() - start)
+            DEVICE_AUTH_FAILURES.labels(self.mac).inc()
+            breaker.record_failure(self.mac)
             _LOGGER.error(
                 "Can't connect to device %s (IP: %s MAC: %s)",
                 self.name,
                 self.ip,
                 self.mac,
             )
+            evict_device(self.mac_hex)
+            set_cached_status(self.mac_hex, False)
             return None
+
+        rtt = monotonic() - start
+        add_span(AUTH, rtt)
+        DEVICE_AUTH_LATENCY.labels(self.mac).observe(rtt)
+        breaker.record_success(rtt)
+        with _device_pool_lock:
+            _device_pool[self.mac_hex] = (device, monotonic())
+        set_cached_status(self.mac_hex, True)
         return device
 
+    # Checks availability with a live handshake bounded by STATUS_TIMEOUT. It
+    # goes ahead even while the circuit breaker is open, so the status monitor
+    # closes the breaker as soon as the blaster answers again.
+    def probe(self):
+        if BROKER_SOCKET:
+            return call_broker(self, "probe", self.probe_directly)
+        return self.probe_directly()
+
+    def probe_directly(self):
+        return self.connect(timeout=STATUS_TIMEOUT, check_breaker=False) is not None
+
     def to_dict(self):
+        available, last_seen = get_cached_status(self.mac_hex)
         return {
             "name": self.name,
             "ip": self.ip,
             "mac": self.mac,
-            "available": self.available,
+            "available": available,
+            "last_seen": last_seen.isoformat() if last_seen else None,
         }
 
     def put_name(self, name):
-        check_blaster = Blaster.get_or_none(Blaster.name % name)
+        check_blaster = Blaster.get_or_none(
+            (Blaster.name.collate("NOCASE") == name) & (Blaster.uid != self.uid)
+        )
 
         if check_blaster:
             return False
@@ -71,36 +230,197 @@ class Blaster(BaseBlastersModel):
             self.save()
             return True
 
-    def send_command(self, command):
-        device = self.device
-        if device:
-            device.send_data(dec_b64(command.value))
+    def save(self, *args, **kwargs):
+        with blasters_db.atomic():
+            result = super().save(*args, **kwargs)
+            bump_blasters_version()
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        evict_device(self.mac_hex)
+        reset_breaker(self.mac_hex)
+        with blasters_db.atomic():
+            result = super().delete_instance(*args, **kwargs)
+            BlasterStatus.delete_by_id(self.mac_hex)
+            bump_blasters_version()
+        return result
+
+    def send_command(self, command, repeat=1, gap_ms=0, hold_ms=0):
+        return self.send_repeated(command.payload, repeat, gap_ms, hold_ms)
+
+    def send_raw(self, value, repeat=1, gap_ms=0, hold_ms=0):
+        return self.send_repeated(dec_b64(value), repeat, gap_ms, hold_ms)
+
+    # Sends a code repeat times, or as often as fits in hold_ms. Without a gap
+    # the repeats are left to the device via the packet's repeat byte, so they
+    # cost a single request. With a gap every frame is sent separately and
+    # starts gap_ms after the previous one ended. Raises ValueError if the
+    # length of a hold can't be worked out, or if the repeats would take
+    # longer than MAX_HOLD_MS.
+    def send_repeated(self, payload, repeat=1, gap_ms=0, hold_ms=0):
+        frame_ms = packet_duration_ms(payload)
+
+        if hold_ms:
+            if not frame_ms + gap_ms:
+                raise ValueError(
+                    "Can't tell how long the code takes to send, use a gap"
+                )
+            repeat = max(1, math.ceil(hold_ms / (frame_ms + gap_ms)))
+        elif repeat * (frame_ms + gap_ms) > MAX_HOLD_MS:
+            raise ValueError(
+                "Repeats would take longer than "
+                + str(MAX_HOLD_MS)
+                + " ms, use fewer or a shorter gap"
+            )
+
+        if repeat == 1:
+            return self.send_data(payload)
+
+        if gap_ms or payload[0] not in REPEATABLE_PACKET_TYPES:
+            next_send = monotonic()
+            for _ in range(repeat):
+                pause = next_send - monotonic()
+                if pause > 0:
+                    sleep(pause)
+
+                sent_at = monotonic()
+                if not self.send_data(payload):
+                    return False
+                next_send = sent_at + (frame_ms + gap_ms) / 1000
             return True
-        return False
 
-    def send_raw(self, value):
+        for packet in repeat_packets(payload, repeat):
+            if not self.send_data(packet):
+                return False
+        return True
+
+    def send_data(self, data):
+        if BROKER_SOCKET:
+            return call_broker(
+                self,
+                "send",
+                lambda: self.send_data_directly(data),
+                payload=enc_b64(data),
+            )
+        return self.send_data_directly(data)
+
+    def send_data_directly(self, data):
         device = self.device
-        if device:
-            device.send_data(dec_b64(value))
-            return True
-        else:
+        if not device:
+            return False
+
+        try:
+            self._timed_send_data(device, data)
+        except broadlink.exceptions.NetworkTimeoutError:
+            # Silence means the blaster is gone rather than the session, and
+            # authenticating again would only wait out another timeout
+            _LOGGER.error("Device %s did not respond to a send", self.mac)
+            evict_device(self.mac_hex)
+            set_cached_status(self.mac_hex, False)
             return False
+        except broadlink.exceptions.BroadlinkException:
+            # The pooled session may have gone stale (device rebooted or
+            # dropped our key), so re-authenticate once before giving up.
+            _LOGGER.debug("Re-authenticating device %s after failed send", self.mac)
+            evict_device(self.mac_hex)
+            device = self.connect()
+            if not device:
+                return False
+            self._timed_send_data(device, data)
+        return True
 
-    def get_command(self):
+    def _timed_send_data(self, device, data):
+        breaker = get_breaker(self.mac_hex)
+        device.timeout = breaker.timeout()
+
+        start = monotonic()
+        try:
+            device.send_data(data)
+        except broadlink.exceptions.BroadlinkException as err:
+            add_span(DEVICE, monotonic() - start)
+            DEVICE_SEND_FAILURES.labels(self.mac).inc()
+            # Only silence counts against the blaster, an error reply shows
+            # it is there
+            if isinstance(err, broadlink.exceptions.NetworkTimeoutError):
+                breaker.record_failure(self.mac)
+            raise
+
+        rtt = monotonic() - start
+        add_span(DEVICE, rtt)
+        DEVICE_SEND_LATENCY.labels(self.mac).observe(rtt)
+        breaker.record_success(rtt)
+
+    # Sends each (command, repeat, delay_ms) step over one device session.
+    # delay_ms is measured from the start of one send to the start of the next,
+    # so the device's response time doesn't add to the gaps. Returns the offset
+    # in ms at which each step started, or False if the blaster is unavailable.
+    def send_sequence(self, steps):
+        start = monotonic()
+        next_send = start
+        offsets = []
+
+        for command, repeat, delay_ms in steps:
+            for count in range(repeat):
+                pause = next_send - monotonic()
+                if pause > 0:
+                    sleep(pause)
+
+                sent_at = monotonic()
+                if not count:
+                    offsets.append(round((sent_at - start) * 1000, 1))
+                if not self.send_data(command.payload):
+                    return False
+                next_send = sent_at + delay_ms / 1000
+
+        return offsets
+
+    # Learns a command, returning its base64 value, None if nothing was
+    # received within timeout or the learning job job_id was cancelled, and
+    # False if the blaster is unavailable. The device broker can't call
+    # cancelled, so it checks the job instead.
+    def get_command(self, timeout=LEARNING_TIMEOUT, cancelled=None, job_id=None):
+        if BROKER_SOCKET:
+            return call_broker(
+                self,
+                "learn",
+                lambda: self.get_command_directly(timeout, cancelled),
+                wait=timeout,
+                timeout=timeout,
+                job_id=job_id,
+            )
+        return self.get_command_directly(timeout, cancelled)
+
+    def get_command_directly(self, timeout=LEARNING_TIMEOUT, cancelled=None):
         device = self.device
         if device:
-            device.enter_learning()
+            try:
+                device.enter_learning()
+            except broadlink.exceptions.BroadlinkException:
+                evict_device(self.mac_hex)
+                device = self.connect()
+                if not device:
+                    return False
+                device.enter_learning()
 
-            sleep(2)
-            value = device.check_data()
-            x = 0
+            value = None
+            deadline = monotonic() + timeout
+
+            while monotonic() < deadline:
+                sleep(LEARNING_POLL_INTERVAL)
+                if cancelled and cancelled():
+                    return None
+
+                try:
+                    value = device.check_data()
+                except (
+                    broadlink.exceptions.ReadError,
+                    broadlink.exceptions.StorageError,
+                ):
+                    # Nothing has been captured yet
+                    value = None
 
-            for _ in range(1, 6):
-                value = device.check_data()
                 if value:
                     break
-                else:
-                    sleep(2)
 
             if value and value.replace(b"\x00", b"") != b"":
                 try:
@@ -112,6 +432,303 @@ class Blaster(BaseBlastersModel):
         return False
 
 
+# Indexes for get_blaster_by_name, _by_mac and _by_ip, and for discovery
+# matching the devices it found by mac_hex. Names and MACs are matched
+# ignoring case, since MACs can be written in either case.
+Blaster.add_index(Blaster.name.collate("NOCASE"), name="blaster_name_nocase")
+Blaster.add_index(Blaster.mac.collate("NOCASE"), name="blaster_mac_nocase")
+Blaster.add_index(Blaster.mac_hex.collate("NOCASE"), name="blaster_mac_hex_nocase")
+Blaster.add_index(Blaster.ip, name="blaster_ip")
+
+
+# Hands an action (send, probe or learn) on a blaster to the device broker
+# process (see device_broker.py), which queues them per blaster so only one
+# process ever drives a device. The broker waits up to wait seconds on top of
+# BROKER_TIMEOUT for the action. Calls direct() instead if the broker can't
+# be reached. Returns the action's result.
+def call_broker(blaster, action, direct, wait=0, **params):
+    request = {
+        "action": action,
+        "name": blaster.name,
+        "ip": blaster.ip,
+        "port": blaster.port,
+        "devtype": blaster.devtype,
+        "mac": blaster.mac,
+        "mac_hex": blaster.mac_hex,
+        "wait": wait,
+        **params,
+    }
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        # Leave the broker time to report its own timeout first
+        conn.settimeout(BROKER_TIMEOUT + wait + 5)
+        try:
+            conn.connect(BROKER_SOCKET)
+        except OSError as err:
+            _LOGGER.warning(
+                "Device broker unavailable (%s), handling %s of %s directly",
+                err,
+                action,
+                blaster.mac,
+            )
+            return direct()
+
+        start = monotonic()
+        try:
+            conn.sendall(json.dumps(request).encode() + b"\n")
+            with conn.makefile("rb") as reader:
+                response = reader.readline()
+        except OSError as err:
+            raise broadlink.exceptions.BroadlinkException(
+                "Device broker error: " + str(err)
+            )
+        finally:
+            add_span(DEVICE, monotonic() - start)
+
+    if not response:
+        raise broadlink.exceptions.BroadlinkException(
+            "Device broker closed the connection"
+        )
+
+    result = json.loads(response)
+    if result.get("error"):
+        raise broadlink.exceptions.BroadlinkException(result["error"])
+    return result["result"]
+
+
+def get_pooled_device(mac_hex, host):
+    with _device_pool_lock:
+        entry = _device_pool.get(mac_hex)
+
+    if entry:
+        device, authenticated_at = entry
+        if device.host == host and monotonic() - authenticated_at < DEVICE_TTL:
+            count_cache_lookup("device_pool", True)
+            return device
+        evict_device(mac_hex)
+    count_cache_lookup("device_pool", False)
+    return None
+
+
+def evict_device(mac_hex):
+    with _device_pool_lock:
+        _device_pool.pop(mac_hex, None)
+
+
+# Circuit breaker of one blaster, which also keeps track of its round trip
+# times. After BREAKER_FAILURES consecutive timeouts the breaker opens and
+# requests fail straight away instead of each waiting for the device timeout.
+# Once BREAKER_COOLDOWN seconds have passed, one request at a time is let
+# through (half-open) to check on the blaster; if it answers the breaker
+# closes, if not it stays open for another cooldown. Timeouts follow the
+# blaster's smoothed round trip time plus four times its deviation, like TCP's
+# retransmission timeout, between MIN_DEVICE_TIMEOUT and DEVICE_TIMEOUT.
+class DeviceBreaker(object):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.srtt = None
+        self.rttvar = None
+        self._lock = Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            # A half-open check that never reported back lets another through
+            # after a cooldown too
+            if monotonic() - self.opened_at < BREAKER_COOLDOWN:
+                return False
+            self.state = self.HALF_OPEN
+            self.opened_at = monotonic()
+            return True
+
+    # Seconds until the breaker lets a check through, 0 unless it is open
+    def cooldown_left(self):
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(0, BREAKER_COOLDOWN - (monotonic() - self.opened_at))
+
+    def timeout(self):
+        with self._lock:
+            if self.srtt is None:
+                return DEVICE_TIMEOUT
+            return min(
+                DEVICE_TIMEOUT, max(MIN_DEVICE_TIMEOUT, self.srtt + 4 * self.rttvar)
+            )
+
+    def record_success(self, rtt):
+        with self._lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self, mac):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.OPEN:
+                return
+            if self.state == self.CLOSED and self.failures < BREAKER_FAILURES:
+                return
+            self.state = self.OPEN
+            self.opened_at = monotonic()
+
+        DEVICE_BREAKER_TRIPS.labels(mac).inc()
+        _LOGGER.warning(
+            "Device %s failed %d times in a row, failing fast for %s seconds",
+            mac,
+            self.failures,
+            BREAKER_COOLDOWN,
+        )
+
+
+def get_breaker(mac_hex):
+    with _breakers_lock:
+        breaker = _breakers.get(mac_hex)
+        if not breaker:
+            breaker = _breakers[mac_hex] = DeviceBreaker()
+        return breaker
+
+
+def reset_breaker(mac_hex):
+    with _breakers_lock:
+        _breakers.pop(mac_hex, None)
+
+
+# Returns the (available, last_seen) tuple of a blaster, (None, None) if it
+# hasn't been checked yet
+def get_cached_status(mac_hex):
+    status = BlasterStatus.get_or_none(BlasterStatus.mac_hex == mac_hex)
+    return (status.available, status.last_seen) if status else (None, None)
+
+
+def set_cached_status(mac_hex, available):
+    with blasters_db.atomic():
+        was_available, last_seen = get_cached_status(mac_hex)
+        if available:
+            last_seen = datetime.utcnow()
+        # A response moves last_seen on, so only repeated failures change nothing
+        if available or available != was_available:
+            BlasterStatus.replace(
+                mac_hex=mac_hex, available=available, last_seen=last_seen
+            ).execute()
+            if not StatusVersion.update(version=StatusVersion.version + 1).execute():
+                StatusVersion.create(version=1)
+
+    # Only the process that recorded the change publishes it
+    if available != was_available:
+        publish_event(
+            BLASTER_STATUS,
+            {"mac": friendly_mac_from_hex(mac_hex.lower()), "available": available},
+            key=mac_hex.lower(),
+        )
+
+
+def get_status_version():
+    row = StatusVersion.get_or_none()
+    return row.version if row else 0
+
+
+def get_blasters_version():
+    row = BlasterVersion.get_or_none()
+    return row.version if row else 0
+
+
+def bump_blasters_version():
+    with blasters_db.atomic():
+        if not BlasterVersion.update(version=BlasterVersion.version + 1).execute():
+            BlasterVersion.create(version=1)
+
+
+def probe_blasters(blasters):
+    if blasters:
+        # Each probe runs in its own copy of the caller's context, so the
+        # request's profile sees them
+        with ThreadPoolExecutor(max_workers=len(blasters)) as executor:
+            futures = [
+                executor.submit(copy_context().run, blaster.probe)
+                for blaster in blasters
+            ]
+            for future in futures:
+                future.result()
+
+
+# Checks the status of every blaster every interval seconds with
+# probe(blasters)
+def start_status_monitor(interval=STATUS_INTERVAL, probe=probe_blasters):
+    global _status_monitor
+
+    if interval <= 0 or (_status_monitor and _status_monitor.is_alive()):
+        return
+
+    _status_monitor = Thread(
+        target=_monitor_status,
+        args=(interval, probe),
+        name="status-monitor",
+        daemon=True,
+    )
+    _status_monitor.start()
+
+
+def _monitor_status(interval, probe):
+    while True:
+        try:
+            with blasters_db.connection_context():
+                blasters = get_all_blasters()
+            probe(blasters)
+        except Exception:
+            _LOGGER.exception("Unexpected error while checking blaster status")
+        sleep(interval)
+
+
+def packet_duration_ms(payload):
+    # Sum of the packet's timing values times the frames it already sends, or
+    # 0 if it isn't a Broadlink IR/RF packet
+    if len(payload) < 4 or payload[0] not in REPEATABLE_PACKET_TYPES:
+        return 0
+
+    end = min(len(payload), 4 + (payload[2] | payload[3] << 8))
+    ticks = 0
+    index = 4
+    while index < end:
+        if payload[index]:
+            ticks += payload[index]
+            index += 1
+        else:
+            # 0x00 marks a two byte big endian value
+            ticks += int.from_bytes(payload[index + 1 : index + 3], "big")
+            index += 3
+
+    return ticks * PACKET_TICK_MS * (payload[1] + 1)
+
+
+def repeat_packets(payload, repeat):
+    # Copies of payload whose repeat bytes add up to repeat times the frames it
+    # already sends, as few as the one byte repeat count allows
+    frames = payload[1] + 1
+    per_packet = 256 // frames
+    packets = []
+
+    while repeat > 0:
+        count = min(repeat, per_packet)
+        packet = bytearray(payload)
+        packet[1] = frames * count - 1
+        packets.append(packet)
+        repeat -= count
+    return packets
+
+
 def friendly_mac_from_hex(raw):
     return ":".join([raw[(x * 2) : ((x + 1) * 2)] for x in range(0, 6)])
 
@@ -125,7 +742,8 @@ def dec_hex(raw):
 
 
 def enc_b64(raw):
-    return codecs.encode(raw, encoding="base64").decode()
+    # Without the line breaks codecs adds, so values round trip exactly
+    return base64.b64encode(raw).decode()
 
 
 def dec_b64(raw):
@@ -135,39 +753,144 @@ def dec_b64(raw):
 def discover_blasters(timeout):
     return [
         blaster
-        for blaster in broadlink.discover(timeout=timeout)
+        for blaster in broadlink.discover(
+            timeout=timeout,
+            discover_ip_address=DISCOVERY_ADDRESS,
+            discover_ip_port=DISCOVERY_PORT,
+        )
         if blaster.get_type().lower() in ("rm2", "rm4")
     ]
 
 
 def get_new_blasters(timeout=DISCOVERY_TIMEOUT):
-    cnt = 0
+    with DISCOVERY_LATENCY.time():
+        found = {
+            enc_hex(device.mac): device for device in discover_blasters(timeout=timeout)
+        }
+    DISCOVERY_DEVICES.set(len(found))
+    if not found:
+        return {"new_devices": 0, "moved_devices": 0, "devices_found": 0}
 
-    for blaster in discover_blasters(timeout=timeout):
-        mac_hex = enc_hex(blaster.mac)
-        mac = friendly_mac_from_hex(mac_hex)
-        check_blaster = Blaster.get_or_none(
-            Blaster.mac_hex % mac_hex
-        ) or Blaster.get_or_none(Blaster.mac % mac)
+    # mac_hex may differ in case if the DB was edited by hand, so blasters are
+    # matched case insensitively and their stored mac_hex is the upsert key
+    known = {
+        blaster.mac_hex.lower(): blaster
+        for blaster in Blaster.select().where(
+            Blaster.mac_hex.collate("NOCASE").in_(list(found))
+        )
+    }
 
-        if check_blaster:
-            check_blaster.ip = blaster.host[0]
-            check_blaster.port = blaster.host[1]
-            check_blaster.mac = mac
-            check_blaster.mac_hex = mac_hex
-            check_blaster.save()
-        else:
-            Blaster.create(
-                ip=blaster.host[0],
-                port=blaster.host[1],
-                devtype=blaster.devtype,
-                mac_hex=mac_hex,
-                mac=friendly_mac_from_hex(mac_hex),
-                name=None,
-            )
-            cnt += 1
+    rows = []
+    moved = []
+    for mac_hex, device in found.items():
+        blaster = known.get(mac_hex)
+        if blaster:
+            if (blaster.ip, blaster.port) == tuple(device.host):
+                continue
+            moved.append(blaster.mac_hex)
+            mac_hex = blaster.mac_hex
+
+        rows.append(
+            {
+                "ip": device.host[0],
+                "port": device.host[1],
+                "devtype": device.devtype,
+                "mac": friendly_mac_from_hex(mac_hex.lower()),
+                "mac_hex": mac_hex,
+            }
+        )
+
+    # New and moved blasters are written in one statement; unchanged ones
+    # aren't written at all
+    if rows:
+        with blasters_db.atomic():
+            Blaster.insert_many(rows).on_conflict(
+                conflict_target=[Blaster.mac_hex],
+                preserve=[Blaster.ip, Blaster.port, Blaster.mac],
+            ).execute()
+            bump_blasters_version()
+
+    # Sessions and round trip times for the old address are useless now
+    for mac_hex in moved:
+        evict_device(mac_hex)
+        reset_breaker(mac_hex)
+
+    for row in rows:
+        publish_event(
+            BLASTER_MOVED if row["mac_hex"] in moved else BLASTER_FOUND,
+            {"mac": row["mac"], "ip": row["ip"], "port": row["port"]},
+            key=row["mac_hex"].lower(),
+        )
+
+    return {
+        "new_devices": len(rows) - len(moved),
+        "moved_devices": len(moved),
+        "devices_found": len(found),
+    }
+
+
+def start_discovery(initial_timeout=DISCOVERY_TIMEOUT, interval=DISCOVERY_INTERVAL):
+    global _discovery_loop
+
+    if _discovery_loop and _discovery_loop.is_alive():
+        return
+
+    _discovery_loop = Thread(
+        target=_run_discovery,
+        args=(initial_timeout, interval),
+        name="discovery",
+        daemon=True,
+    )
+    _discovery_loop.start()
+
+
+def initial_discovery_done():
+    with _discovery_condition:
+        return _discovery_finished > 0
 
-    return {"new_devices": cnt}
+
+# Returns the latest discovery results, or None if no run has finished yet.
+# With wait, a new run is started and waited for for up to wait seconds; the
+# second value tells whether the results are from that run.
+def get_discovery_results(wait=0):
+    with _discovery_condition:
+        if wait <= 0:
+            return _discovery_results, True
+
+        # A run that is already in progress may have missed a new device
+        target = _discovery_started + 1
+        _discovery_requested.set()
+        fresh = _discovery_condition.wait_for(
+            lambda: _discovery_finished >= target, timeout=wait
+        )
+        return _discovery_results, fresh
+
+
+def _run_discovery(initial_timeout, interval):
+    global _discovery_results, _discovery_started, _discovery_finished
+
+    timeout = initial_timeout
+    while True:
+        with _discovery_condition:
+            _discovery_requested.clear()
+            _discovery_started += 1
+
+        results = None
+        try:
+            with blasters_db.connection_context():
+                results = get_new_blasters(timeout=timeout)
+            results["finished"] = datetime.utcnow().isoformat()
+        except Exception:
+            _LOGGER.exception("Unexpected error while discovering blasters")
+
+        with _discovery_condition:
+            if results:
+                _discovery_results = results
+            _discovery_finished += 1
+            _discovery_condition.notify_all()
+
+        timeout = DISCOVERY_TIMEOUT
+        _discovery_requested.wait(interval if interval > 0 else None)
 
 
 def get_all_blasters():
@@ -177,25 +900,215 @@ def get_all_blasters():
         return []
 
 
-def get_all_blasters_as_dict():
-    try:
-        return [blaster.to_dict() for blaster in Blaster.select()]
-    except Blaster.DoesNotExist:
-        return []
+def get_all_blasters_as_dict(fresh=False):
+    return get_blasters_page(fresh=fresh)[0]
+
+
+# Returns up to limit blasters as dicts, starting after the uid after, and the
+# after value of the next page (None on the last page). fresh=True checks the
+# blasters on the page first.
+def get_blasters_page(limit=None, after=None, fresh=False):
+    blasters, next_after = paginate(Blaster.select(), Blaster.uid, limit, after)
+    if fresh:
+        probe_blasters(blasters)
+    return [blaster.to_dict() for blaster in blasters], next_after
+
+
+# Keyset pagination of query by key, a unique column. Returns the rows (up to
+# limit of them) whose key is greater than after, and the key of the last row
+# if there are more, so the next page is a seek on key's index however deep
+# into the table it starts.
+def paginate(query, key, limit=None, after=None):
+    if after is not None:
+        query = query.where(key > after)
+    query = query.order_by(key)
+
+    if limit is None:
+        return list(query), None
+
+    rows = list(query.limit(limit + 1))
+    if len(rows) > limit:
+        return rows[:limit], getattr(rows[limit - 1], key.name)
+    return rows, None
 
 
 def get_blaster_by_name(name):
-    return Blaster.get_or_none(Blaster.name % name)
+    return Blaster.get_or_none(Blaster.name.collate("NOCASE") == name)
 
 
 def get_blaster_by_ip(ip):
-    return Blaster.get_or_none(Blaster.ip % ip)
+    return Blaster.get_or_none(Blaster.ip == ip)
 
 
 def get_blaster_by_mac(mac):
-    return Blaster.get_or_none(Blaster.mac % mac)
+    return Blaster.get_or_none(Blaster.mac.collate("NOCASE") == mac)
+
+
+def send_command_to_all_blasters(command, timeout=BROADCAST_TIMEOUT):
+    blasters = get_all_blasters()
+    if not blasters:
+        return {}
+
+    # Every blaster gets its own thread so that one slow or offline device
+    # can't hold up the others; all of them share a single deadline. The
+    # threads run in copies of the caller's context so the request's profile
+    # sees their spans.
+    executor = ThreadPoolExecutor(max_workers=len(blasters))
+    futures = {
+        executor.submit(
+            copy_context().run, _timed_send, blaster, command.payload
+        ): blaster
+        for blaster in blasters
+    }
+    done, _ = wait(futures, timeout=timeout)
+    executor.shutdown(wait=False)
+
+    results = {}
+    for future, blaster in futures.items():
+        if future in done:
+            results[blaster.mac] = dict(name=blaster.name, **future.result())
+        else:
+            results[blaster.mac] = {
+                "name": blaster.name,
+                "success": False,
+                "latency_ms": round(timeout * 1000, 1),
+                "error": "Timed out",
+            }
+    return results
 
 
-def send_command_to_all_blasters(command):
-    for blaster in get_all_blasters():
-        blaster.send_command(command)
+# A broadcast only counts as sent if it reached at least one blaster
+def broadcast_succeeded(results):
+    return any(result["success"] for result in results.values())
+
+
+# Sends shared by all workers, keyed by the JSON of the caller's key (see
+# share_send). token tells attempts with the same key apart, and expires is a
+# Unix time since workers don't share a monotonic clock.
+class SharedSend(BaseBlastersModel):
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+
+    key = TextField(primary_key=True)
+    token = TextField()
+    request = TextField()
+    state = TextField()
+    result = TextField(null=True)
+    error = TextField(null=True)
+    error_type = TextField(null=True)
+    expires = FloatField(index=True)
+
+    # Returns the result of the finished send, or raises its error
+    def outcome(self):
+        if self.error is None:
+            return json.loads(self.result)
+        if self.error_type == "ValueError":
+            raise ValueError(self.error)
+        raise broadlink.exceptions.BroadlinkException(self.error)
+
+
+# Runs send() unless a send with the same key is in flight or finished less
+# than window seconds ago, in any worker, in which case its result is returned
+# (or its error raised) instead. request describes what is being sent, and
+# reusing a key for a different request raises ValueError. Failed sends, ones
+# that raised or whose result succeeded(result) rejects, are forgotten as soon
+# as they finish so a retry sends again. Keys and requests must be JSON
+# serializable, and so must the results of send().
+def share_send(key, window, send, request=None, succeeded=bool):
+    key = json.dumps(key)
+    request = json.dumps(request)
+
+    while True:
+        shared, token = _claim_send(key, request)
+        if token:
+            break
+        if shared.request != request:
+            raise ValueError("Key was already used for a different request")
+        shared = _wait_for_send(key, shared.token)
+        if shared:
+            return shared.outcome()
+        # The send was taken over or expired while waiting, so start over
+
+    try:
+        result = send()
+    except Exception as err:
+        _finish_send(key, token, SharedSend.FAILED, 0, error=err)
+        raise
+    _finish_send(
+        key,
+        token,
+        SharedSend.DONE if succeeded(result) else SharedSend.FAILED,
+        window,
+        result,
+    )
+    return result
+
+
+# Returns the live send for key and None, or claims key and returns None and
+# the token of the new attempt. Finished sends are purged from the DB once they
+# are SHARED_SEND_TIMEOUT past expiry, so no waiter can miss their outcome.
+def _claim_send(key, request):
+    global _shared_sends_purged
+
+    now = time()
+    with blasters_db.atomic():
+        if monotonic() - _shared_sends_purged >= 1:
+            SharedSend.delete().where(
+                SharedSend.expires < now - SHARED_SEND_TIMEOUT
+            ).execute()
+            _shared_sends_purged = monotonic()
+
+        shared = SharedSend.get_or_none(SharedSend.key == key)
+        if shared and shared.state != SharedSend.FAILED and shared.expires > now:
+            return shared, None
+
+        token = os.urandom(8).hex()
+        SharedSend.replace(
+            key=key,
+            token=token,
+            request=request,
+            state=SharedSend.PENDING,
+            expires=now + SHARED_SEND_TIMEOUT,
+        ).execute()
+        return None, token
+
+
+# Polls for the outcome of attempt token of the send for key. Returns None if
+# the attempt was replaced, or if it is still pending past its expiry because
+# its worker died.
+def _wait_for_send(key, token):
+    while True:
+        shared = SharedSend.get_or_none(SharedSend.key == key)
+        if not shared or shared.token != token:
+            return None
+        if shared.state != SharedSend.PENDING:
+            return shared
+        if shared.expires <= time():
+            return None
+        sleep(SHARED_SEND_POLL_INTERVAL)
+
+
+def _finish_send(key, token, state, window, result=None, error=None):
+    SharedSend.update(
+        state=state,
+        result=json.dumps(result),
+        error=None if error is None else str(error) or type(error).__name__,
+        error_type=None if error is None else type(error).__name__,
+        expires=time() + window,
+    ).where((SharedSend.key == key) & (SharedSend.token == token)).execute()
+
+
+def _timed_send(blaster, data):
+    start = monotonic()
+    try:
+        success = blaster.send_data(data)
+        error = None if success else "Blaster unavailable"
+    except broadlink.exceptions.BroadlinkException as err:
+        success = False
+        error = str(err)
+
+    result = {"success": success, "latency_ms": round((monotonic() - start) * 1000, 1)}
+    if error:
+        result["error"] = error
+    return result
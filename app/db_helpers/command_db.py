@@ -1,16 +1,65 @@
+from collections import namedtuple
+import hashlib
+import json
+import os
+import string
+from threading import Lock
+from time import monotonic
+import zlib
+
 from peewee import (
+    JOIN,
     AutoField,
+    BlobField,
+    BooleanField,
     DateTimeField,
     ForeignKeyField,
+    IntegerField,
     Model,
-    SqliteDatabase,
     TextField,
 )
 
+from .blaster_db import dec_b64, enc_b64, paginate
+from .event_db import CATALOG, publish_event
+from .metrics import TimedSqliteDatabase, count_cache_lookup
+from .sqlite_config import SQLITE_OPTIONS
+
+CATALOG_CHECK_INTERVAL = float(os.environ.get("BROADLINK_CATALOG_CHECK_INTERVAL", "1"))
+IMPORT_BATCH_SIZE = 500
+MAX_IMPORT_ERRORS = 1000
+MAX_STEP_REPEAT = 100
+MAX_STEP_DELAY_MS = 60000
+MAX_STEPS = 100
+# Longest a sequence may take from its first send to its last, since the
+# request holds a worker throughout
+MAX_SEQUENCE_MS = 60000
+MAX_DEBOUNCE_MS = 60000
+# Fields of a command that list requests can ask for
+COMMAND_FIELDS = ("name", "value", "debounce_ms")
+# Payloads at least this large (long RF captures) are stored compressed if that
+# makes them smaller, 0 disables compression
+COMPRESSION_THRESHOLD = int(
+    os.environ.get("BROADLINK_PAYLOAD_COMPRESSION_THRESHOLD", "512")
+)
 
 commands_db_path = "data/commands.db"
 
-commands_db = SqliteDatabase(commands_db_path)
+commands_db = TimedSqliteDatabase(commands_db_path, **SQLITE_OPTIONS)
+
+# Read-through cache of commands used on the send path, keyed by case folded
+# (target name, command name) with the IR/RF payload already decoded. The cache
+# is dropped whenever the catalog version in the DB changes, which other
+# workers check at most once every CATALOG_CHECK_INTERVAL seconds.
+CachedCommand = namedtuple(
+    "CachedCommand", ["target_name", "name", "payload", "debounce_ms"]
+)
+
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+_catalog = {}
+_catalog_version = None
+_catalog_checked = 0
+_catalog_lock = Lock()
 
 ## Commands DB classes and functions
 
@@ -20,6 +69,53 @@ class BaseCommandsModel(Model):
         database = commands_db
 
 
+class CatalogModel(BaseCommandsModel):
+    # Any change to a catalog row invalidates the command cache in every worker
+    # and is published as a catalog event naming the row. The change and the
+    # version bump are committed together, and this worker's cache is cleared
+    # again after the commit in case it was refilled from the old row.
+
+    def save(self, *args, **kwargs):
+        with commands_db.atomic():
+            self.save_dependencies()
+            result = super().save(*args, **kwargs)
+            bump_catalog_version()
+        clear_command_cache()
+        publish_event(CATALOG, dict(action="saved", **self.event_data()))
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        with commands_db.atomic():
+            result = super().delete_instance(*args, **kwargs)
+            bump_catalog_version()
+        clear_command_cache()
+        publish_event(CATALOG, dict(action="deleted", **self.event_data()))
+        return result
+
+    def event_data(self):
+        return {}
+
+    # Writes rows this one refers to, in the transaction that saves it
+    def save_dependencies(self):
+        pass
+
+
+class CatalogVersion(BaseCommandsModel):
+    version = IntegerField(default=0)
+
+
+# Raw IR/RF codes keyed by the SHA-256 of the code, so a code learned for
+# several targets is stored once. The REST API still exchanges base64 values.
+class Payload(BaseCommandsModel):
+    digest = TextField(primary_key=True)
+    data = BlobField()
+    compressed = BooleanField(default=False)
+
+    @property
+    def raw(self):
+        return unpack_payload(self.data, self.compressed)
+
+
 class Encoding(BaseCommandsModel):
     encoding = TextField(unique=True)
     active_since = DateTimeField()
@@ -28,44 +124,82 @@ class Encoding(BaseCommandsModel):
         return {"encoding": self.encoding, "active_since": self.active_since}
 
 
-class Target(BaseCommandsModel):
+class Target(CatalogModel):
     uid = AutoField()
     name = TextField(unique=True)
 
     def to_dict(self):
         return {"name": self.name}
 
+    def event_data(self):
+        return {"target": self.name}
+
     def get_command(self, name):
-        return Command.get_or_none((Command.target == self) & (Command.name % name))
+        return (
+            Command.select(Command, Payload)
+            .join(Payload)
+            .where((Command.target == self) & (Command.name.collate("NOCASE") == name))
+            .get_or_none()
+        )
 
     def get_all_commands(self):
         try:
-            return [command for command in self.commands]
+            return [command for command in self.commands_with_payloads()]
         except:
             return []
 
     def get_all_commands_as_dict(self):
-        return [command.to_dict() for command in self.commands]
+        return [command.to_dict() for command in self.commands_with_payloads()]
+
+    # Returns up to limit commands as dicts of fields, starting after the uid
+    # after, and the after value of the next page (None on the last page).
+    # Payloads are only read if value is one of the fields.
+    def get_commands_page(self, fields=COMMAND_FIELDS, limit=None, after=None):
+        if "value" in fields:
+            query = Command.select(Command, Payload).join(Payload)
+        else:
+            query = Command.select(Command.uid, Command.name, Command.debounce_ms)
+
+        commands, next_after = paginate(
+            query.where(Command.target == self), Command.uid, limit, after
+        )
+        return [command.to_dict(fields) for command in commands], next_after
+
+    def commands_with_payloads(self):
+        return (
+            Command.select(Command, Payload)
+            .join(Payload)
+            .where(Command.target == self)
+            .order_by(Command.uid)
+        )
 
     def add_command(self, name, value):
 
-        if Command.get_or_none((Command.target == self) & (Command.name % name)):
+        if Command.get_or_none(
+            (Command.target == self) & (Command.name.collate("NOCASE") == name)
+        ):
             return False
         else:
             Command.create(target=self, name=name, value=value)
             return True
 
-    def put_command(self, name, value):
-        command = Command.get_or_none((Command.target == self) & (Command.name % name))
+    def put_command(self, name, value, debounce_ms=None):
+        with commands_db.atomic():
+            command = Command.get_or_none(
+                (Command.target == self) & (Command.name.collate("NOCASE") == name)
+            )
 
-        if command:
+            if not command:
+                command = Command(target=self, name=name)
             command.value = value
+            if debounce_ms is not None:
+                command.debounce_ms = debounce_ms
             command.save()
-        else:
-            Command.create(target=self, name=name, value=value)
 
     def delete_command(self, name):
-        command = Command.get_or_none((Command.target == self) & (Command.name % name))
+        command = Command.get_or_none(
+            (Command.target == self) & (Command.name.collate("NOCASE") == name)
+        )
 
         if command:
             return bool(command.delete_instance())
@@ -73,7 +207,9 @@ class Target(BaseCommandsModel):
             return False
 
     def update_name(self, new_name):
-        check_target = Target.get_or_none(Target.name % new_name)
+        check_target = Target.get_or_none(
+            (Target.name.collate("NOCASE") == new_name) & (Target.uid != self.uid)
+        )
 
         if check_target:
             return False
@@ -83,20 +219,51 @@ class Target(BaseCommandsModel):
             return True
 
 
-class Command(BaseCommandsModel):
+class Command(CatalogModel):
     uid = AutoField()
     target = ForeignKeyField(Target, backref="commands")
     name = TextField()
-    value = TextField()
+    code = ForeignKeyField(Payload, column_name="payload_digest")
+    # Repeats of a send arriving within this many ms of it share its result
+    # instead of sending again (useful for toggles), 0 turns it off
+    debounce_ms = IntegerField(default=0)
 
-    def to_dict(self):
-        return {"name": self.name, "value": self.value}
+    def to_dict(self, fields=COMMAND_FIELDS):
+        return {field: getattr(self, field) for field in fields}
+
+    def event_data(self):
+        return {"target": self.target.name, "command": self.name}
 
     def get_value(self):
         return self.value
 
+    @property
+    def payload(self):
+        return self.code.raw
+
+    # Base64 value as used by the REST API. Setting it decodes the value,
+    # raising ValueError if it isn't valid, and the payload is stored when the
+    # command is saved.
+    @property
+    def value(self):
+        return enc_b64(self.payload)
+
+    @value.setter
+    def value(self, value):
+        self._new_payload = decode_value(value)
+
+    def save_dependencies(self):
+        new_payload = getattr(self, "_new_payload", None)
+        if new_payload is not None:
+            self.code = put_payload(new_payload)
+            self._new_payload = None
+
     def update_name(self, new_name):
-        check_command = Command.get_or_none(Command.name % new_name)
+        check_command = Command.get_or_none(
+            (Command.target == self.target_id)
+            & (Command.name.collate("NOCASE") == new_name)
+            & (Command.uid != self.uid)
+        )
 
         if check_command:
             return False
@@ -109,6 +276,30 @@ class Command(BaseCommandsModel):
         indexes = ((("target", "name"), True),)
 
 
+# Named, ordered list of steps, each step a dict of target, command, repeat and
+# delay_ms (the pause after every send of the step)
+class Macro(CatalogModel):
+    uid = AutoField()
+    name = TextField(unique=True)
+    steps = TextField()
+
+    def to_dict(self):
+        return {"name": self.name, "steps": json.loads(self.steps)}
+
+    def event_data(self):
+        return {"macro": self.name}
+
+
+# Target, macro and command names are matched ignoring case. Command names
+# are only unique within a target, so that index leads with the target and
+# also finds all of a target's commands.
+Macro.add_index(Macro.name.collate("NOCASE"), name="macro_name_nocase")
+Target.add_index(Target.name.collate("NOCASE"), name="target_name_nocase")
+Command.add_index(
+    Command.target, Command.name.collate("NOCASE"), name="command_target_name_nocase"
+)
+
+
 def get_all_targets():
     try:
         return [target for target in Target.select()]
@@ -123,12 +314,180 @@ def get_all_targets_as_dict():
         return []
 
 
+def get_targets_page(limit=None, after=None):
+    targets, next_after = paginate(Target.select(), Target.uid, limit, after)
+    return [target.to_dict() for target in targets], next_after
+
+
+def iter_targets_with_commands(fields=("name", "value"), limit=None, after=None):
+    # Yields (target uid, target name, command uid, command) rows ordered by
+    # target from a single query, where command is a dict of the requested
+    # fields, or None (with a command uid of 0) for an empty target. Payloads
+    # are only read for the value field. after is the (target uid, command uid)
+    # of an earlier row to continue from, and limit caps the number of rows.
+    query = Target.select(
+        Target.uid, Target.name, Command.uid, Command.name, Command.debounce_ms
+    ).join(Command, JOIN.LEFT_OUTER)
+    if "value" in fields:
+        query = query.select_extend(Payload.data, Payload.compressed).join(
+            Payload, JOIN.LEFT_OUTER
+        )
+
+    if after:
+        target_uid, command_uid = after
+        query = query.where(
+            (Target.uid >= target_uid)
+            & ((Target.uid > target_uid) | (Command.uid > command_uid))
+        )
+
+    rows = query.order_by(Target.uid, Command.uid).limit(limit).tuples().iterator()
+    for uid, target_name, command_uid, command_name, debounce_ms, *payload in rows:
+        command = None
+        if command_uid is not None:
+            values = {"name": command_name, "debounce_ms": debounce_ms}
+            if payload:
+                values["value"] = enc_b64(unpack_payload(*payload))
+            command = {field: values[field] for field in fields}
+        yield uid, target_name, command_uid or 0, command
+
+
+def import_commands(lines, dry_run=False):
+    # Upserts NDJSON lines of {"target": ..., "name": ..., "value": ...} with an
+    # optional "debounce_ms" (left as it is when missing; a line without name
+    # only creates the target) in a single transaction, inserting
+    # new commands in batches. Invalid lines are skipped and reported by line
+    # number. A dry run validates and counts everything, then rolls back. The
+    # write lock is held while lines are read, so they shouldn't come straight
+    # from a client.
+    result = {
+        "targets_created": 0,
+        "commands_created": 0,
+        "commands_updated": 0,
+        "errors": [],
+    }
+
+    def add_error(number, error):
+        if len(result["errors"]) < MAX_IMPORT_ERRORS:
+            result["errors"].append({"line": number, "error": error})
+
+    with commands_db.atomic() as transaction:
+        targets = {
+            nocase_key(name): uid
+            for uid, name in Target.select(Target.uid, Target.name).tuples()
+        }
+        commands = {
+            (target_id, nocase_key(name))
+            for target_id, name in Command.select(Command.target, Command.name).tuples()
+        }
+        pending = {}
+
+        for number, line in enumerate(lines, 1):
+            if isinstance(line, bytes):
+                line = line.decode("utf-8", errors="replace")
+            if not line.strip():
+                continue
+
+            try:
+                row = json.loads(line)
+            except ValueError:
+                add_error(number, "Invalid JSON")
+                continue
+
+            if not isinstance(row, dict) or not isinstance(row.get("target"), str):
+                add_error(number, "Line must be an object with a target")
+                continue
+
+            target_name = row["target"]
+            command_name = row.get("name")
+            value = row.get("value")
+            debounce_ms = row.get("debounce_ms")
+
+            if command_name is not None:
+                if not isinstance(command_name, str) or not isinstance(value, str):
+                    add_error(number, "Command name and value must be strings")
+                    continue
+                try:
+                    raw = decode_value(value)
+                except ValueError as err:
+                    add_error(number, str(err))
+                    continue
+                if debounce_ms is not None and (
+                    not isinstance(debounce_ms, int)
+                    or isinstance(debounce_ms, bool)
+                    or not 0 <= debounce_ms <= MAX_DEBOUNCE_MS
+                ):
+                    add_error(
+                        number,
+                        "debounce_ms must be between 0 and " + str(MAX_DEBOUNCE_MS),
+                    )
+                    continue
+
+            target_id = targets.get(nocase_key(target_name))
+            if target_id is None:
+                target_id = Target.insert(name=target_name).execute()
+                targets[nocase_key(target_name)] = target_id
+                result["targets_created"] += 1
+
+            if command_name is None:
+                continue
+
+            digest = put_payload(raw)
+            changes = {"code": digest}
+            if debounce_ms is not None:
+                changes["debounce_ms"] = debounce_ms
+
+            key = (target_id, nocase_key(command_name))
+            if key in commands:
+                Command.update(**changes).where(
+                    (Command.target == target_id)
+                    & (Command.name.collate("NOCASE") == command_name)
+                ).execute()
+                result["commands_updated"] += 1
+            elif key in pending:
+                pending[key].update(changes)
+                result["commands_updated"] += 1
+            else:
+                pending[key] = {
+                    "target": target_id,
+                    "name": command_name,
+                    "debounce_ms": 0,
+                    **changes,
+                }
+                result["commands_created"] += 1
+
+            if len(pending) >= IMPORT_BATCH_SIZE:
+                Command.insert_many(pending.values()).execute()
+                commands.update(pending)
+                pending = {}
+
+        if pending:
+            Command.insert_many(pending.values()).execute()
+
+        if dry_run:
+            transaction.rollback()
+        else:
+            bump_catalog_version()
+
+    if not dry_run:
+        clear_command_cache()
+        publish_event(
+            CATALOG,
+            {
+                "action": "imported",
+                "targets_created": result["targets_created"],
+                "commands_created": result["commands_created"],
+                "commands_updated": result["commands_updated"],
+            },
+        )
+    return result
+
+
 def get_target(name):
-    return Target.get_or_none(Target.name % name)
+    return Target.get_or_none(Target.name.collate("NOCASE") == name)
 
 
 def add_target(name):
-    if Target.get_or_none(Target.name % name):
+    if Target.get_or_none(Target.name.collate("NOCASE") == name):
         return False
     else:
         Target.create(name=name)
@@ -136,10 +495,223 @@ def add_target(name):
 
 
 def delete_target(name):
-    target = Target.get_or_none(Target.name % name)
+    target = Target.get_or_none(Target.name.collate("NOCASE") == name)
 
     if target:
         target.delete_instance(recursive=True, delete_nullable=True)
         return True
     else:
         return False
+
+
+def get_all_macros_as_dict():
+    return [macro.to_dict() for macro in Macro.select()]
+
+
+def get_macro(name):
+    return Macro.get_or_none(Macro.name.collate("NOCASE") == name)
+
+
+def put_macro(name, steps):
+    macro = get_macro(name)
+
+    if macro:
+        macro.steps = json.dumps(steps)
+        macro.save()
+    else:
+        Macro.create(name=name, steps=json.dumps(steps))
+
+
+def delete_macro(name):
+    macro = get_macro(name)
+
+    if macro:
+        return bool(macro.delete_instance())
+    else:
+        return False
+
+
+def normalize_steps(steps):
+    # Validates client supplied sequence steps and fills in defaults, raising
+    # ValueError with a description of the first invalid step
+    if not isinstance(steps, list) or not steps:
+        raise ValueError("Steps must be a non-empty list")
+    if len(steps) > MAX_STEPS:
+        raise ValueError("A sequence can have at most " + str(MAX_STEPS) + " steps")
+
+    normalized = []
+    for index, step in enumerate(steps):
+        if not isinstance(step, dict):
+            raise ValueError("Step " + str(index) + " must be an object")
+
+        target_name = step.get("target")
+        command_name = step.get("command")
+        repeat = step.get("repeat", 1)
+        delay_ms = step.get("delay_ms", 0)
+
+        if not isinstance(target_name, str) or not isinstance(command_name, str):
+            raise ValueError("Step " + str(index) + " must have a target and a command")
+        if not isinstance(repeat, int) or not 1 <= repeat <= MAX_STEP_REPEAT:
+            raise ValueError(
+                "Step "
+                + str(index)
+                + " repeat must be between 1 and "
+                + str(MAX_STEP_REPEAT)
+            )
+        if (
+            not isinstance(delay_ms, (int, float))
+            or not 0 <= delay_ms <= MAX_STEP_DELAY_MS
+        ):
+            raise ValueError(
+                "Step "
+                + str(index)
+                + " delay_ms must be between 0 and "
+                + str(MAX_STEP_DELAY_MS)
+            )
+
+        normalized.append(
+            {
+                "target": target_name,
+                "command": command_name,
+                "repeat": repeat,
+                "delay_ms": delay_ms,
+            }
+        )
+
+    # Every send but the last waits for its step's delay_ms
+    duration_ms = sum(step["repeat"] * step["delay_ms"] for step in normalized)
+    if duration_ms - normalized[-1]["delay_ms"] > MAX_SEQUENCE_MS:
+        raise ValueError(
+            "Steps would take longer than " + str(MAX_SEQUENCE_MS) + " ms to send"
+        )
+    return normalized
+
+
+def resolve_steps(steps):
+    # Looks up every step's command up front so a sequence either runs in full
+    # or not at all, returning (command, repeat, delay_ms) tuples
+    resolved = []
+    for step in normalize_steps(steps):
+        command = get_cached_command(step["target"], step["command"])
+        if not command:
+            raise ValueError(
+                "Command '"
+                + step["command"]
+                + "' not found for Target '"
+                + step["target"]
+                + "'"
+            )
+        resolved.append((command, step["repeat"], step["delay_ms"]))
+    return resolved
+
+
+def decode_value(value):
+    # Decodes a base64 value from the REST API, raising ValueError unless it
+    # holds a code
+    try:
+        raw = dec_b64(value)
+    except (AttributeError, ValueError):
+        raw = None
+    if not raw:
+        raise ValueError("Value is not valid base64")
+    return raw
+
+
+def pack_payload(raw):
+    # Returns (data, compressed) as stored in the Payload table
+    if COMPRESSION_THRESHOLD and len(raw) >= COMPRESSION_THRESHOLD:
+        packed = zlib.compress(raw, 9)
+        if len(packed) < len(raw):
+            return packed, True
+    return raw, False
+
+
+def unpack_payload(data, compressed):
+    return zlib.decompress(data) if compressed else bytes(data)
+
+
+def put_payload(raw):
+    # Stores raw unless an identical payload exists and returns its digest
+    raw = bytes(raw)
+    digest = hashlib.sha256(raw).hexdigest()
+    data, compressed = pack_payload(raw)
+    Payload.insert(
+        digest=digest, data=data, compressed=compressed
+    ).on_conflict_ignore().execute()
+    return digest
+
+
+def delete_unused_payloads():
+    unused = Payload.digest.not_in(Command.select(Command.code))
+    return Payload.delete().where(unused).execute()
+
+
+def nocase_key(value):
+    # Folds case the same way as SQLite's NOCASE collation (ASCII letters only)
+    return value.translate(_ASCII_LOWER)
+
+
+def get_catalog_version():
+    row = CatalogVersion.get_or_none()
+    return row.version if row else 0
+
+
+def bump_catalog_version():
+    with commands_db.atomic():
+        if not CatalogVersion.update(version=CatalogVersion.version + 1).execute():
+            CatalogVersion.create(version=1)
+        # Codes that are no longer used by any command go with the change
+        delete_unused_payloads()
+
+    clear_command_cache()
+
+
+def clear_command_cache():
+    global _catalog_version, _catalog_checked
+
+    with _catalog_lock:
+        _catalog.clear()
+        _catalog_version = None
+        _catalog_checked = 0
+
+
+def _validate_catalog():
+    global _catalog_version, _catalog_checked
+
+    if monotonic() - _catalog_checked < CATALOG_CHECK_INTERVAL:
+        return _catalog_version
+
+    version = get_catalog_version()
+    with _catalog_lock:
+        if version != _catalog_version:
+            _catalog.clear()
+            _catalog_version = version
+        _catalog_checked = monotonic()
+    return version
+
+
+def get_cached_command(target_name, command_name):
+    version = _validate_catalog()
+    key = (nocase_key(target_name), nocase_key(command_name))
+
+    cached = _catalog.get(key)
+    count_cache_lookup("commands", cached is not None)
+    if cached:
+        return cached
+
+    target = get_target(target_name)
+    command = target.get_command(command_name) if target else None
+    if not command:
+        return None
+
+    cached = CachedCommand(
+        target_name=target.name,
+        name=command.name,
+        payload=command.payload,
+        debounce_ms=command.debounce_ms,
+    )
+    with _catalog_lock:
+        # Don't cache a row read while the catalog was being changed
+        if version is not None and version == _catalog_version:
+            _catalog[key] = cached
+    return cached
@@ -0,0 +1,178 @@
+from collections import deque
+import json
+import logging
+import os
+import socketserver
+from threading import Condition, Event, Lock, Thread
+from time import monotonic, sleep
+
+from .blaster_db import (
+    BROKER_SOCKET,
+    BROKER_TIMEOUT,
+    Blaster,
+    dec_b64,
+    start_status_monitor,
+)
+from .learning_db import is_cancelled
+
+BROKER_MIN_GAP = float(os.environ.get("BROADLINK_BROKER_MIN_GAP_MS", "0")) / 1000
+BROKER_COALESCE = os.environ.get("BROADLINK_BROKER_COALESCE", "0") == "1"
+
+_LOGGER = logging.getLogger(__name__)
+
+#### Device broker
+
+# A single process that owns the connection to every blaster. Workers hand
+# their sends, probes and learning to it over a Unix socket (see
+# blaster_db.call_broker) as one JSON line per request and get one JSON line
+# back. Jobs are queued FIFO per blaster and run on one thread per blaster, so
+# concurrent requests from different workers can't collide on a device and
+# rapid presses arrive in order. Optionally a minimum gap is kept between
+# sends to the same blaster, and a send identical to one that is still queued
+# joins it instead of being sent twice. The broker also runs the status
+# monitor, so blasters are checked (and authenticated) once per interval
+# rather than once per worker.
+
+
+# run() does the job on the blaster; payload is set for sends
+class DeviceJob(object):
+    def __init__(self, blaster, run, payload=None):
+        self.blaster = blaster
+        self.run = run
+        self.payload = payload
+        self.result = None
+        self.error = None
+        self.done = Event()
+
+
+class DeviceQueue(object):
+    def __init__(self, min_gap=BROKER_MIN_GAP, coalesce=BROKER_COALESCE):
+        self.min_gap = min_gap
+        self.coalesce = coalesce
+        self._jobs = deque()
+        self._condition = Condition()
+        self._last_send = 0
+        Thread(target=self._run, name="device-queue", daemon=True).start()
+
+    def submit(self, blaster, run, payload=None):
+        with self._condition:
+            if self.coalesce and payload is not None:
+                for job in self._jobs:
+                    if job.payload == payload:
+                        return job
+
+            job = DeviceJob(blaster, run, payload)
+            self._jobs.append(job)
+            self._condition.notify()
+            return job
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._jobs:
+                    self._condition.wait()
+                job = self._jobs.popleft()
+
+            if job.payload is not None:
+                pause = self._last_send + self.min_gap - monotonic()
+                if pause > 0:
+                    sleep(pause)
+
+            try:
+                job.result = job.run()
+            except Exception as err:
+                job.error = str(err) or type(err).__name__
+            if job.payload is not None:
+                self._last_send = monotonic()
+            job.done.set()
+
+
+_queues = {}
+_queues_lock = Lock()
+
+
+def get_queue(mac_hex):
+    with _queues_lock:
+        if mac_hex not in _queues:
+            _queues[mac_hex] = DeviceQueue()
+        return _queues[mac_hex]
+
+
+def handle_request(request):
+    # Blasters are rebuilt from the request rather than read from the DB so the
+    # broker always uses the address the worker just looked up
+    blaster = Blaster(
+        name=request["name"],
+        ip=request["ip"],
+        port=request["port"],
+        devtype=request["devtype"],
+        mac=request["mac"],
+        mac_hex=request["mac_hex"],
+    )
+    queue = get_queue(blaster.mac_hex)
+    action = request.get("action", "send")
+
+    if action == "send":
+        payload = bytes(dec_b64(request["payload"]))
+        job = queue.submit(
+            blaster, lambda: blaster.send_data_directly(payload), payload
+        )
+    elif action == "probe":
+        job = queue.submit(blaster, blaster.probe_directly)
+    elif action == "learn":
+        job_id = request.get("job_id")
+        job = queue.submit(
+            blaster,
+            lambda: blaster.get_command_directly(
+                float(request["timeout"]),
+                (lambda: is_cancelled(job_id)) if job_id else None,
+            ),
+        )
+    else:
+        raise ValueError("Unknown action " + str(action))
+
+    if not job.done.wait(BROKER_TIMEOUT + float(request.get("wait", 0))):
+        return {"result": False, "error": "Timed out waiting for the blaster"}
+    return {"result": job.result, "error": job.error}
+
+
+# Probes the blasters on their queues, so checks wait for sends in progress
+def probe_blasters(blasters):
+    jobs = [
+        get_queue(blaster.mac_hex).submit(blaster, blaster.probe_directly)
+        for blaster in blasters
+    ]
+    for job in jobs:
+        job.done.wait(BROKER_TIMEOUT)
+
+
+class BrokerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = handle_request(json.loads(line))
+            except (KeyError, ValueError) as err:
+                response = {"result": False, "error": "Invalid request: " + str(err)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class BrokerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path=BROKER_SOCKET):
+    if os.path.exists(path):
+        os.unlink(path)
+
+    start_status_monitor(probe=probe_blasters)
+
+    with BrokerServer(path, BrokerRequestHandler) as server:
+        _LOGGER.info("Device broker listening on %s", path)
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if not BROKER_SOCKET:
+        raise SystemExit("Set BROADLINK_BROKER_SOCKET to run the device broker")
+    serve()
@@ -0,0 +1,175 @@
+from datetime import datetime, timedelta
+import json
+from logging import getLogger
+import os
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep
+
+from peewee import AutoField, DateTimeField, Model, TextField
+
+from .metrics import TimedSqliteDatabase
+from .sqlite_config import SQLITE_OPTIONS
+
+EVENT_POLL_INTERVAL = float(os.environ.get("BROADLINK_EVENT_POLL_INTERVAL", "0.5"))
+EVENT_RETENTION = float(os.environ.get("BROADLINK_EVENT_RETENTION", "3600"))
+EVENT_STREAM_TIMEOUT = float(os.environ.get("BROADLINK_EVENT_STREAM_TIMEOUT", "300"))
+EVENT_KEEPALIVE = 15
+EVENT_BATCH_SIZE = 100
+PRUNE_INTERVAL = 60
+
+BLASTER_STATUS = "blaster_status"
+BLASTER_FOUND = "blaster_found"
+BLASTER_MOVED = "blaster_moved"
+LEARNING_JOB = "learning_job"
+CATALOG = "catalog"
+
+EVENT_TYPES = (BLASTER_STATUS, BLASTER_FOUND, BLASTER_MOVED, LEARNING_JOB, CATALOG)
+
+_LOGGER = getLogger(__name__)
+
+events_db_path = "data/events.db"
+
+events_db = TimedSqliteDatabase(events_db_path, **SQLITE_OPTIONS)
+
+# Id of the newest event this process knows of. The event feed polls the DB
+# for events published by other workers, events published here are picked up
+# straight away, and _feed_condition is notified whenever the id changes.
+_last_event_id = 0
+_feed_condition = Condition()
+_feed = None
+_feed_lock = Lock()
+
+#### Event DB classes and functions
+
+# Events are appended to their own DB so every worker can publish them and
+# every worker's /events streams see them all. Subscribers wait on the feed
+# and only query the DB when there is something new, so an idle stream costs
+# nothing but the feed's single poll per worker.
+
+
+class Event(Model):
+    uid = AutoField()
+    kind = TextField()
+    key = TextField(null=True)
+    data = TextField()
+    created = DateTimeField(index=True)
+
+    def to_dict(self):
+        return {
+            "id": self.uid,
+            "type": self.kind,
+            "data": json.loads(self.data),
+            "created": self.created.isoformat(),
+        }
+
+    class Meta:
+        database = events_db
+        indexes = ((("kind", "key"), False),)
+
+
+# Publishes an event of kind with a JSON serializable data dict. key names what
+# the event is about; an event with the same data as the latest one of its kind
+# and key is dropped, so workers that each notice the same change (e.g. a
+# blaster going offline) publish it only once. Failures are logged rather than
+# raised, since events must never break the change they report.
+def publish_event(kind, data, key=None):
+    encoded = json.dumps(data, sort_keys=True)
+    try:
+        with events_db.atomic():
+            if key is not None:
+                latest = (
+                    Event.select(Event.data)
+                    .where((Event.kind == kind) & (Event.key == key))
+                    .order_by(Event.uid.desc())
+                    .scalar()
+                )
+                if latest == encoded:
+                    return None
+            event = Event.create(
+                kind=kind, key=key, data=encoded, created=datetime.utcnow()
+            )
+    except Exception:
+        _LOGGER.exception("Could not publish %s event", kind)
+        return None
+
+    _set_last_event_id(event.uid)
+    return event
+
+
+def get_events(after, limit=EVENT_BATCH_SIZE):
+    return list(
+        Event.select().where(Event.uid > after).order_by(Event.uid).limit(limit)
+    )
+
+
+def get_last_event_id():
+    return Event.select(Event.uid).order_by(Event.uid.desc()).scalar() or 0
+
+
+def _set_last_event_id(uid):
+    global _last_event_id
+
+    with _feed_condition:
+        if uid > _last_event_id:
+            _last_event_id = uid
+            _feed_condition.notify_all()
+
+
+def start_event_feed(interval=EVENT_POLL_INTERVAL):
+    global _feed
+
+    with _feed_lock:
+        if _feed and _feed.is_alive():
+            return
+
+        _set_last_event_id(get_last_event_id())
+        _feed = Thread(
+            target=_run_event_feed, args=(interval,), name="event-feed", daemon=True
+        )
+        _feed.start()
+
+
+def _run_event_feed(interval):
+    pruned = monotonic()
+    while True:
+        sleep(interval)
+        try:
+            _set_last_event_id(get_last_event_id())
+
+            if monotonic() - pruned >= PRUNE_INTERVAL:
+                cutoff = datetime.utcnow() - timedelta(seconds=EVENT_RETENTION)
+                Event.delete().where(Event.created < cutoff).execute()
+                pruned = monotonic()
+        except Exception:
+            _LOGGER.exception("Unexpected error while polling for events")
+
+
+# Yields the dicts of events published after the id after (or from now on if
+# it is None) for duration seconds, optionally only those of the given types.
+# None is yielded every EVENT_KEEPALIVE seconds without events, so callers can
+# keep the connection alive and notice clients that went away.
+def iter_events(after=None, types=None, duration=EVENT_STREAM_TIMEOUT):
+    start_event_feed()
+    deadline = monotonic() + duration
+
+    with _feed_condition:
+        if after is None:
+            after = _last_event_id
+
+    while True:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return
+
+        with _feed_condition:
+            newer = _feed_condition.wait_for(
+                lambda: _last_event_id > after, timeout=min(EVENT_KEEPALIVE, remaining)
+            )
+        if not newer:
+            yield None
+            continue
+
+        for event in get_events(after):
+            after = event.uid
+            if types is None or event.kind in types:
+                yield event.to_dict()
@@ -0,0 +1,186 @@
+from datetime import datetime, timedelta
+from logging import getLogger
+from threading import Thread
+from uuid import uuid4
+
+from peewee import DateTimeField, TextField
+
+from . import command_db
+from .blaster_db import LEARNING_TIMEOUT, BaseBlastersModel, blasters_db
+from .event_db import LEARNING_JOB, publish_event
+from .metrics import LEARNING_JOBS
+
+_LOGGER = getLogger(__name__)
+
+# Finished jobs are kept this long so clients can still collect the result
+JOB_RETENTION = timedelta(days=1)
+
+PENDING = "pending"
+LEARNING = "learning"
+COMPLETED = "completed"
+TIMED_OUT = "timed_out"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+ACTIVE_STATUSES = (PENDING, LEARNING)
+
+#### Learning job DB classes and functions
+
+# Jobs are persisted in the blasters DB so any worker can report on or cancel
+# a job, while the capture itself runs on a thread in the worker that created it.
+
+
+class LearningJob(BaseBlastersModel):
+    job_id = TextField(primary_key=True)
+    blaster_mac = TextField(index=True)
+    target_name = TextField()
+    command_name = TextField()
+    status = TextField(default=PENDING)
+    value = TextField(null=True)
+    error = TextField(null=True)
+    created = DateTimeField()
+    finished = DateTimeField(null=True)
+
+    @property
+    def done(self):
+        return self.status not in ACTIVE_STATUSES
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "blaster_mac": self.blaster_mac,
+            "target_name": self.target_name,
+            "command_name": self.command_name,
+            "status": self.status,
+            "value": self.value,
+            "error": self.error,
+            "created": self.created.isoformat(),
+            "finished": self.finished.isoformat() if self.finished else None,
+        }
+
+    def cancel(self):
+        cancelled = bool(
+            LearningJob.update(status=CANCELLED, finished=datetime.utcnow())
+            .where(
+                (LearningJob.job_id == self.job_id)
+                & (LearningJob.status.in_(ACTIVE_STATUSES))
+            )
+            .execute()
+        )
+        if cancelled:
+            LEARNING_JOBS.labels(CANCELLED).inc()
+            publish_event(LEARNING_JOB, get_job(self.job_id).to_dict(), key=self.job_id)
+        return cancelled
+
+
+def get_job(job_id):
+    return LearningJob.get_or_none(LearningJob.job_id == job_id)
+
+
+def get_active_job(blaster):
+    # Jobs whose worker died without finishing them stop blocking the blaster
+    stale_before = datetime.utcnow() - timedelta(seconds=LEARNING_TIMEOUT * 2)
+
+    return LearningJob.get_or_none(
+        (LearningJob.blaster_mac == blaster.mac)
+        & (LearningJob.status.in_(ACTIVE_STATUSES))
+        & (LearningJob.created > stale_before)
+    )
+
+
+def start_job(blaster, target_name, command_name):
+    # The write lock is held from the check on, so two workers can't both start
+    # a job on the same blaster
+    with blasters_db.atomic():
+        if get_active_job(blaster):
+            return None
+
+        now = datetime.utcnow()
+        LearningJob.delete().where(LearningJob.finished < now - JOB_RETENTION).execute()
+
+        job = LearningJob.create(
+            job_id=uuid4().hex,
+            blaster_mac=blaster.mac,
+            target_name=target_name,
+            command_name=command_name,
+            created=now,
+        )
+
+    Thread(
+        target=_run_job,
+        args=(job.job_id, blaster),
+        name="learning-" + job.job_id,
+        daemon=True,
+    ).start()
+
+    return job
+
+
+def is_cancelled(job_id):
+    with blasters_db.connection_context():
+        return LearningJob.get_by_id(job_id).status == CANCELLED
+
+
+def _finish_job(job_id, status, value=None, error=None):
+    with blasters_db.connection_context():
+        finished = (
+            LearningJob.update(
+                status=status, value=value, error=error, finished=datetime.utcnow()
+            )
+            .where(
+                (LearningJob.job_id == job_id)
+                & (LearningJob.status.in_(ACTIVE_STATUSES))
+            )
+            .execute()
+        )
+        job = LearningJob.get_by_id(job_id)
+
+    if finished:
+        LEARNING_JOBS.labels(status).inc()
+        publish_event(LEARNING_JOB, job.to_dict(), key=job_id)
+
+
+def _run_job(job_id, blaster):
+    with blasters_db.connection_context():
+        LearningJob.update(status=LEARNING).where(
+            (LearningJob.job_id == job_id) & (LearningJob.status == PENDING)
+        ).execute()
+        job = LearningJob.get_by_id(job_id)
+
+    if job.status != LEARNING:
+        return
+    publish_event(LEARNING_JOB, job.to_dict(), key=job_id)
+
+    try:
+        value = blaster.get_command(
+            cancelled=lambda: is_cancelled(job_id), job_id=job_id
+        )
+    except Exception as err:
+        _LOGGER.exception("Learning job %s failed", job_id)
+        _finish_job(job_id, FAILED, error=str(err))
+        return
+
+    if value is False:
+        _finish_job(job_id, FAILED, error="Blaster unavailable")
+    elif value is None:
+        if not is_cancelled(job_id):
+            _finish_job(
+                job_id,
+                TIMED_OUT,
+                error="Blaster did not receive any IR signals to learn",
+            )
+    else:
+        with command_db.commands_db.connection_context():
+            target = command_db.get_target(job.target_name)
+            if target:
+                target.put_command(job.command_name, value)
+
+        if target:
+            _finish_job(job_id, COMPLETED, value=value)
+        else:
+            _finish_job(
+                job_id,
+                FAILED,
+                value=value,
+                error="Target '" + job.target_name + "' no longer exists",
+            )
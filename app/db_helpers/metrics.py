@@ -0,0 +1,113 @@
+import os
+from time import monotonic
+
+from peewee import SqliteDatabase
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+from .profiling import DB, add_span
+
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+#### Prometheus metrics
+
+# Every worker records into its own files under PROMETHEUS_MULTIPROC_DIR when
+# it is set (the Docker entrypoint does), and /metrics merges the files of all
+# workers, so counters and histograms are totals for the whole server no matter
+# which worker answers the scrape. Without it, each process reports only itself.
+
+# Device round trips are usually tens of ms, a stalled one hits the timeouts
+DEVICE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+
+REQUEST_LATENCY = Histogram(
+    "broadlink_request_duration_seconds",
+    "Time taken to handle an HTTP request",
+    ["method", "route", "status"],
+)
+DEVICE_AUTH_LATENCY = Histogram(
+    "broadlink_device_auth_duration_seconds",
+    "Time taken to authenticate with a blaster",
+    ["mac"],
+    buckets=DEVICE_BUCKETS,
+)
+DEVICE_AUTH_FAILURES = Counter(
+    "broadlink_device_auth_failures_total",
+    "Authentications that timed out",
+    ["mac"],
+)
+DEVICE_BREAKER_TRIPS = Counter(
+    "broadlink_device_breaker_trips_total",
+    "Times a blaster's circuit breaker opened after repeated timeouts",
+    ["mac"],
+)
+DEVICE_SEND_LATENCY = Histogram(
+    "broadlink_device_send_duration_seconds",
+    "Time taken by a blaster to accept a command",
+    ["mac"],
+    buckets=DEVICE_BUCKETS,
+)
+DEVICE_SEND_FAILURES = Counter(
+    "broadlink_device_send_failures_total",
+    "Sends rejected by a blaster, including ones that succeeded after reconnecting",
+    ["mac"],
+)
+DISCOVERY_LATENCY = Histogram(
+    "broadlink_discovery_duration_seconds",
+    "Time taken by a discovery run",
+    buckets=(0.5, 1, 2.5, 5, 10, 30),
+)
+DISCOVERY_DEVICES = Gauge(
+    "broadlink_discovery_devices_found",
+    "Blasters that answered the latest discovery run",
+    multiprocess_mode="mostrecent",
+)
+LEARNING_JOBS = Counter(
+    "broadlink_learning_jobs_total",
+    "Finished learning jobs by outcome",
+    ["status"],
+)
+DB_QUERY_LATENCY = Histogram(
+    "broadlink_db_query_duration_seconds",
+    "Time taken to execute an SQLite statement",
+    ["db"],
+    buckets=DB_BUCKETS,
+)
+CACHE_LOOKUPS = Counter(
+    "broadlink_cache_lookups_total",
+    "Lookups in the in-process caches by result (hit or miss)",
+    ["cache", "result"],
+)
+
+
+class TimedSqliteDatabase(SqliteDatabase):
+    # Records how long every statement takes, labelled with the DB file name
+    def execute_sql(self, sql, params=None):
+        start = monotonic()
+        try:
+            return super().execute_sql(sql, params)
+        finally:
+            elapsed = monotonic() - start
+            DB_QUERY_LATENCY.labels(os.path.basename(self.database)).observe(elapsed)
+            add_span(DB, elapsed)
+
+
+def count_cache_lookup(cache, hit):
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def render():
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
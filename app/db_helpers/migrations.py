@@ -0,0 +1,242 @@
+from contextlib import contextmanager
+from datetime import datetime
+import fcntl
+from logging import getLogger
+import os
+
+from peewee import DateTimeField, IntegerField, Model, TextField
+from playhouse import migrate as schema
+
+from . import blaster_db, command_db, event_db, learning_db
+
+_LOGGER = getLogger(__name__)
+
+migrations_lock_path = "data/.migrations.lock"
+
+#### Schema setup and data migrations
+
+# Every step here is idempotent, so it is safe for each gunicorn worker to run
+# init_databases() at startup. The DB schema version is recorded in each DB's
+# schemaversion table and migrations only run while holding a file lock, so
+# exactly one process applies them and the rest return after a single query.
+
+
+class SchemaVersion(Model):
+    version = IntegerField(primary_key=True)
+    applied = DateTimeField()
+
+
+def _command_columns():
+    return {column.name for column in command_db.commands_db.get_columns("command")}
+
+
+def _migrate_hex_to_base64():
+    # Commands used to be stored as hex. DBs created after the switch have an
+    # Encoding table, so only older DBs are converted. The value column is no
+    # longer part of the model (see _migrate_values_to_payloads), hence the SQL.
+    if command_db.Encoding.table_exists():
+        return
+
+    db = command_db.commands_db
+    if "value" in _command_columns():
+        rows = db.execute_sql("SELECT uid, value FROM command").fetchall()
+        try:
+            values = [
+                (blaster_db.enc_b64(blaster_db.dec_hex(value)), uid)
+                for uid, value in rows
+            ]
+        except ValueError:
+            # Values that aren't hex are already base64
+            values = []
+
+        for value, uid in values:
+            db.execute_sql("UPDATE command SET value = ? WHERE uid = ?", (value, uid))
+
+    command_db.Encoding.create_table(safe=True)
+    command_db.Encoding.create(encoding="base64", active_since=datetime.utcnow())
+
+
+def _migrate_values_to_payloads():
+    # Moves base64 command values into the deduplicated Payload table as raw
+    # bytes. DBs created after the switch have no value column.
+    db = command_db.commands_db
+    columns = _command_columns()
+
+    if "value" in columns:
+        migrator = schema.SqliteMigrator(db)
+        if "payload_digest" not in columns:
+            schema.migrate(
+                migrator.add_column("command", "payload_digest", TextField(null=True)),
+                migrator.add_index("command", ("payload_digest",)),
+            )
+
+        rows = db.execute_sql("SELECT uid, value FROM command").fetchall()
+        for uid, value in rows:
+            try:
+                payload = blaster_db.dec_b64(value)
+            except (AttributeError, ValueError):
+                payload = None
+            if not payload:
+                _quarantine_command(uid)
+                continue
+
+            digest = command_db.put_payload(payload)
+            db.execute_sql(
+                "UPDATE command SET payload_digest = ? WHERE uid = ?", (digest, uid)
+            )
+
+        schema.migrate(migrator.drop_column("command", "value"))
+
+    command_db.Encoding.create(encoding="blob", active_since=datetime.utcnow())
+
+
+def _quarantine_command(uid):
+    # Values used to be stored as sent, so a command may hold something that
+    # isn't base64 and could never be sent. It is moved to the invalid_command
+    # table, keeping the value for a manual fix, instead of failing the
+    # migration and with it the app's startup.
+    db = command_db.commands_db
+    db.execute_sql(
+        "CREATE TABLE IF NOT EXISTS invalid_command AS "
+        "SELECT uid, target_id, name, value FROM command WHERE 0"
+    )
+    db.execute_sql(
+        "INSERT INTO invalid_command "
+        "SELECT uid, target_id, name, value FROM command WHERE uid = ?",
+        (uid,),
+    )
+    db.execute_sql("DELETE FROM command WHERE uid = ?", (uid,))
+    _LOGGER.warning(
+        "Moved command %s to the invalid_command table, its value is not base64",
+        uid,
+    )
+
+
+def _add_command_debounce():
+    # DBs created after Command.debounce_ms was added already have the column
+    if "debounce_ms" not in _command_columns():
+        migrator = schema.SqliteMigrator(command_db.commands_db)
+        schema.migrate(
+            migrator.add_column("command", "debounce_ms", IntegerField(default=0))
+        )
+
+
+# Ordered (version, migration) pairs for each DB. Append new migrations with the
+# next version number; never renumber or remove applied ones.
+BLASTERS_DB_MIGRATIONS = []
+
+COMMANDS_DB_MIGRATIONS = [
+    (1, _migrate_hex_to_base64),
+    (2, _migrate_values_to_payloads),
+    (3, _add_command_debounce),
+]
+
+
+def create_tables():
+    # The Encoding table is the hex migration's marker, so that migration
+    # creates it instead
+    blaster_db.blasters_db.create_tables(
+        [
+            blaster_db.Blaster,
+            blaster_db.BlasterVersion,
+            blaster_db.BlasterStatus,
+            blaster_db.StatusVersion,
+            blaster_db.SharedSend,
+            learning_db.LearningJob,
+        ],
+        safe=True,
+    )
+    event_db.events_db.create_tables([event_db.Event], safe=True)
+    command_db.commands_db.create_tables(
+        [
+            command_db.Target,
+            command_db.Payload,
+            command_db.Macro,
+            command_db.CatalogVersion,
+        ],
+        safe=True,
+    )
+    # Until _migrate_values_to_payloads has run, an existing command table has
+    # no payload_digest column for the model's indexes
+    if not command_db.Command.table_exists() or "payload_digest" in _command_columns():
+        command_db.Command.create_table(safe=True)
+
+
+def get_schema_version(db):
+    with db.bind_ctx([SchemaVersion]):
+        if not SchemaVersion.table_exists():
+            return 0
+        return (
+            SchemaVersion.select(SchemaVersion.version)
+            .order_by(SchemaVersion.version.desc())
+            .scalar()
+            or 0
+        )
+
+
+def needs_migration():
+    return any(
+        get_schema_version(db) < migrations[-1][0]
+        for db, migrations in _all_migrations()
+        if migrations
+    )
+
+
+def migrate(db, migrations):
+    with db.bind_ctx([SchemaVersion]):
+        SchemaVersion.create_table(safe=True)
+        current = get_schema_version(db)
+
+        applied = False
+        for version, migration in migrations:
+            if version <= current:
+                continue
+
+            _LOGGER.info("Applying %s migration %s", db.database, version)
+            with db.atomic():
+                migration()
+                SchemaVersion.create(version=version, applied=datetime.utcnow())
+            applied = True
+
+    # Give the space freed by migrations back to the file system
+    if applied:
+        db.execute_sql("VACUUM")
+
+
+def init_databases():
+    create_tables()
+
+    if not needs_migration():
+        return
+
+    with _migrations_lock():
+        for db, migrations in _all_migrations():
+            migrate(db, migrations)
+
+    # Adds any indexes that had to wait for the migrations
+    create_tables()
+
+    command_db.bump_catalog_version()
+
+
+def _all_migrations():
+    return (
+        (blaster_db.blasters_db, BLASTERS_DB_MIGRATIONS),
+        (command_db.commands_db, COMMANDS_DB_MIGRATIONS),
+    )
+
+
+@contextmanager
+def _migrations_lock():
+    os.makedirs(os.path.dirname(migrations_lock_path), exist_ok=True)
+
+    with open(migrations_lock_path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+if __name__ == "__main__":
+    init_databases()
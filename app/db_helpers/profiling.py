@@ -0,0 +1,159 @@
+import cProfile
+from contextvars import ContextVar
+from logging import getLogger
+import os
+import re
+from threading import Lock
+from time import monotonic, time_ns
+
+SERVER_TIMING = os.environ.get("BROADLINK_SERVER_TIMING", "0") == "1"
+SLOW_REQUEST_MS = float(os.environ.get("BROADLINK_SLOW_REQUEST_MS", "0"))
+PROFILE_SAMPLE_RATE = float(os.environ.get("BROADLINK_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_HEADER = os.environ.get("BROADLINK_PROFILE_HEADER", "0") == "1"
+MAX_PROFILES = 100
+
+# Spans in the order they are reported
+DB = "db"
+AUTH = "auth"
+DEVICE = "device"
+SERIALIZE = "serialize"
+SPANS = (DB, AUTH, DEVICE, SERIALIZE)
+
+# Whether any request is ever profiled; if not, the app doesn't install the
+# profiling middleware and add_span only finds that no request is profiled
+ENABLED = bool(
+    SERVER_TIMING or SLOW_REQUEST_MS > 0 or PROFILE_SAMPLE_RATE > 0 or PROFILE_HEADER
+)
+
+_LOGGER = getLogger(__name__)
+
+profiles_path = "data/profiles"
+
+# Profile of the request being handled, carried into the threads that work on
+# it by copying the context
+_current = ContextVar("request_profile", default=None)
+
+# Python 3.12+ can't run two cProfile profilers at once, so requests that are
+# sampled while another one is being profiled only get their spans recorded
+_profiler_lock = Lock()
+
+#### Request profiling
+
+# Every request handled while profiling is enabled gets a RequestProfile,
+# which adds up the time spent in each span: DB statements (including opening
+# the connection), authentication with a blaster, other blaster round trips
+# (or waiting for the device broker), and serializing the response. Spans
+# running in parallel, like the sends of a broadcast, add up to more than the
+# request took. Requests can also run under cProfile, whose stats are dumped
+# into profiles_path to be read with python -m pstats or a viewer like
+# snakeviz.
+
+
+class RequestProfile(object):
+    def __init__(self, method, path, profiled=False):
+        self.method = method
+        self.path = path
+        self.start = monotonic()
+        self.spans = {}
+        self.profiler = None
+        self._lock = Lock()
+
+        if profiled and _profiler_lock.acquire(blocking=False):
+            self.profiler = cProfile.Profile()
+
+    def add(self, name, seconds):
+        with self._lock:
+            count, total = self.spans.get(name, (0, 0))
+            self.spans[name] = (count + 1, total + seconds)
+
+    def elapsed_ms(self):
+        return (monotonic() - self.start) * 1000
+
+    def server_timing(self, total_ms):
+        return ", ".join(
+            [
+                '%s;dur=%.1f;desc="%d calls"' % (name, total * 1000, count)
+                for name, (count, total) in self._sorted_spans()
+            ]
+            + ["total;dur=%.1f" % total_ms]
+        )
+
+    def summary(self):
+        return ", ".join(
+            "%s %.1f ms in %d" % (name, total * 1000, count)
+            for name, (count, total) in self._sorted_spans()
+        )
+
+    def _sorted_spans(self):
+        with self._lock:
+            return [(name, self.spans[name]) for name in SPANS if name in self.spans]
+
+
+# Adds seconds to the span name of the request being handled, if it is
+# profiled. This is all the instrumented code pays when it isn't.
+def add_span(name, seconds):
+    profile = _current.get()
+    if profile is not None:
+        profile.add(name, seconds)
+
+
+def start_profile(method, path, profiled=False):
+    profile = RequestProfile(method, path, profiled)
+    _current.set(profile)
+    return profile
+
+
+# Calls func with the request's cProfile profiler enabled, if it has one. The
+# profiler only sees the thread that enabled it, so this runs on the thread
+# that does the work.
+def call_profiled(func, *args, **kwargs):
+    profile = _current.get()
+    if profile is None or profile.profiler is None:
+        return func(*args, **kwargs)
+
+    profile.profiler.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profile.profiler.disable()
+
+
+# Finishes the profile of the request being handled: logs it if the request
+# was slow and dumps its cProfile stats. route is the route template the
+# request matched. Returns the value of its Server-Timing header.
+def finish_profile(profile, route):
+    _current.set(None)
+    total_ms = profile.elapsed_ms()
+
+    if SLOW_REQUEST_MS > 0 and total_ms >= SLOW_REQUEST_MS:
+        _LOGGER.warning(
+            "Slow request %s %s took %.1f ms (%s)",
+            profile.method,
+            profile.path,
+            total_ms,
+            profile.summary() or "no spans",
+        )
+
+    if profile.profiler:
+        try:
+            dump_profile(profile, route)
+        except OSError:
+            _LOGGER.exception("Could not save the profile of %s", profile.path)
+        finally:
+            profile.profiler = None
+            _profiler_lock.release()
+
+    return profile.server_timing(total_ms)
+
+
+def dump_profile(profile, route):
+    os.makedirs(profiles_path, exist_ok=True)
+    name = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+    profile.profiler.dump_stats(
+        os.path.join(profiles_path, "%d-%s-%s.prof" % (time_ns(), profile.method, name))
+    )
+
+    # Names start with the time, so the oldest come first
+    dumps = sorted(os.listdir(profiles_path))
+    for stale in dumps[: max(0, len(dumps) - MAX_PROFILES)]:
+        os.remove(os.path.join(profiles_path, stale))
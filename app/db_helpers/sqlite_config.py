@@ -0,0 +1,29 @@
+import os
+
+SQLITE_JOURNAL_MODE = os.environ.get("BROADLINK_SQLITE_JOURNAL_MODE", "wal")
+SQLITE_SYNCHRONOUS = os.environ.get("BROADLINK_SQLITE_SYNCHRONOUS", "normal")
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("BROADLINK_SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("BROADLINK_SQLITE_CACHE_SIZE_KB", "8192"))
+SQLITE_MMAP_SIZE_MB = int(os.environ.get("BROADLINK_SQLITE_MMAP_SIZE_MB", "64"))
+
+#### SQLite connection settings
+
+# Used for every DB. In WAL mode readers don't block behind a writer, and with
+# synchronous=NORMAL commits don't wait for an fsync (a power cut can lose the
+# latest commits but never corrupts the DB). Writers wait up to busy_timeout ms
+# for each other, and transactions take the write lock as they begin, so one
+# that reads before it writes can't fail with "database is locked" when
+# another worker wrote in between.
+SQLITE_OPTIONS = {
+    "pragmas": (
+        ("journal_mode", SQLITE_JOURNAL_MODE),
+        ("synchronous", SQLITE_SYNCHRONOUS),
+        ("busy_timeout", SQLITE_BUSY_TIMEOUT_MS),
+        # Negative cache sizes are in KiB
+        ("cache_size", -SQLITE_CACHE_SIZE_KB),
+        ("mmap_size", SQLITE_MMAP_SIZE_MB * 1024 * 1024),
+    ),
+    "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000,
+    # Needs peewee 4.5+, older versions pass it on to sqlite3.connect()
+    "lock_type": "IMMEDIATE",
+}
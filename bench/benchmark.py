@@ -0,0 +1,206 @@
+"""Benchmarks the REST server against simulated blasters.
+
+Starts the simulator from rm_simulator.py, imports the falcon app from app/ with
+its DBs in a temporary directory and drives it in-process, so no hardware or
+network setup is needed:
+
+    python bench/benchmark.py --devices 4 --latency-ms 20 --requests 200
+
+Reports latency percentiles and requests/sec for discovery, single sends,
+broadcasts, listing and the read endpoints. --json saves the results and
+--baseline compares them with saved results, exiting with status 1 when a
+scenario got slower by more than --tolerance, so CI can catch regressions.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+import tempfile
+import time
+
+from rm_simulator import RMSimulator
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app")
+
+# A short but valid IR code in the Broadlink format, base64 encoded
+BENCH_CODE = "JgAcAB0dHB44HhweGx4cHR06HB0cHhwdHB8bHhwADQUAAAAAAAAAAAAAAAA="
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_scenario(client, method, path, requests, concurrency, **params):
+    def timed_request(_):
+        start = time.perf_counter()
+        result = client.simulate_request(method, path, params=params)
+        if result.status_code >= 400:
+            raise RuntimeError(
+                method + " " + path + " returned " + result.status + ": " + result.text
+            )
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(timed_request, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "requests": requests,
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(samples, 0.5) * 1000, 2),
+        "p90_ms": round(percentile(samples, 0.9) * 1000, 2),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 2),
+        "max_ms": round(max(samples) * 1000, 2),
+    }
+
+
+def load_app(simulator, args):
+    # The app reads its settings from the environment and opens its DBs
+    # relative to the working directory when it is imported
+    os.environ.update(
+        {
+            "BROADLINK_DISCOVERY_ADDRESS": simulator.discovery_address[0],
+            "BROADLINK_DISCOVERY_PORT": str(simulator.discovery_address[1]),
+            "BROADLINK_DISCOVERY_TIMEOUT": str(args.discovery_timeout),
+            "BROADLINK_STATUS_INTERVAL": "0",
+        }
+    )
+    os.chdir(tempfile.mkdtemp(prefix="broadlink-bench-"))
+    os.makedirs("data")
+    sys.path.insert(0, os.path.abspath(APP_DIR))
+
+    from falcon import testing
+
+    import app
+
+    client = testing.TestClient(app.app)
+    deadline = time.monotonic() + 10
+    while client.simulate_get("/ready").status_code != 200:
+        if time.monotonic() > deadline:
+            raise RuntimeError("The app did not finish its startup discovery")
+        time.sleep(0.1)
+    return client
+
+
+def run_benchmarks(client, simulator, args):
+    online = [device for device in simulator.devices if not device.offline]
+    if not online:
+        raise RuntimeError("At least one simulated blaster must be online")
+
+    client.simulate_put(
+        "/blasters/mac/" + online[0].mac_str, params={"new_name": "bench"}
+    )
+    client.simulate_put("/targets/bench")
+    client.simulate_put("/targets/bench/commands/power", params={"value": BENCH_CODE})
+    send = {"target_name": "bench", "command_name": "power"}
+    discover = {"wait": 2 * args.discovery_timeout}
+
+    # Broadcasts take as long as the slowest blaster, so they get fewer requests
+    broadcasts = max(1, args.requests // 10)
+    status = "/blasters/name/bench/status"
+    scenarios = [
+        ("discovery", "GET", "/discoverblasters", args.discovery_runs, 1, discover),
+        ("send", "POST", "/blasters/name/bench", args.requests, args.concurrency, send),
+        ("broadcast", "POST", "/blasters", broadcasts, 1, send),
+        ("list_blasters", "GET", "/blasters", args.requests, args.concurrency, {}),
+        ("status", "GET", status, args.requests, args.concurrency, {}),
+        ("list_targets", "GET", "/targets", args.requests, args.concurrency, {}),
+        ("list_commands", "GET", "/commands", args.requests, args.concurrency, {}),
+    ]
+
+    results = {}
+    for name, method, path, requests, concurrency, params in scenarios:
+        results[name] = run_scenario(
+            client, method, path, requests, concurrency, **params
+        )
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        for key in ("p50_ms", "p90_ms"):
+            if result[key] > previous[key] * (1 + tolerance):
+                regressions.append(
+                    "%s %s: %s ms, was %s ms" % (name, key, result[key], previous[key])
+                )
+        if result["rps"] < previous["rps"] * (1 - tolerance):
+            regressions.append(
+                "%s rps: %s, was %s" % (name, result["rps"], previous["rps"])
+            )
+    return regressions
+
+
+def print_results(results):
+    columns = ("requests", "rps", "p50_ms", "p90_ms", "p99_ms", "max_ms")
+    print(("%-15s" + "%10s" * len(columns)) % (("scenario",) + columns))
+    for name, result in results.items():
+        print(
+            ("%-15s" + "%10s" * len(columns))
+            % ((name,) + tuple(result[column] for column in columns))
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--offline", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--loss", type=float, default=0)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--discovery-runs", type=int, default=3)
+    parser.add_argument("--discovery-timeout", type=float, default=1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="save the results to this file")
+    parser.add_argument("--baseline", help="compare with results saved by --json")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed slowdown against the baseline as a fraction (default 0.25)",
+    )
+    args = parser.parse_args()
+
+    # The app runs in a temporary directory, so resolve paths first
+    for name in ("json", "baseline"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    simulator = RMSimulator(
+        devices=args.devices,
+        offline=args.offline,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        loss=args.loss,
+        seed=args.seed,
+    )
+    with simulator:
+        client = load_app(simulator, args)
+        results = run_benchmarks(client, simulator, args)
+
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print("\nRegressions against " + args.baseline + ":")
+            print("\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
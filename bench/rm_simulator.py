@@ -0,0 +1,334 @@
+"""Simulated Broadlink RM blasters for testing and benchmarking without hardware.
+
+Speaks enough of the RM UDP protocol (discovery, auth, sending and learning
+codes) for broadlink.discover() and broadlink.rm to talk to it on localhost:
+
+    python bench/rm_simulator.py --devices 4 --latency-ms 30 --loss 0.01
+
+Then start the app with the BROADLINK_DISCOVERY_ADDRESS and
+BROADLINK_DISCOVERY_PORT values it prints, so discovery finds the simulated
+blasters instead of broadcasting on the LAN.
+"""
+
+import argparse
+import base64
+import os
+import random
+import socket
+import struct
+from threading import Lock, Thread
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+# Protocol constants shared with python-broadlink
+DEFAULT_KEY = bytes.fromhex("097628343fe99e23765c1513accf8b02")
+IV = bytes.fromhex("562e17996d093d28ddb3ba695a2e6f58")
+MAGIC = bytes([0x5A, 0xA5, 0xAA, 0x55, 0x5A, 0xA5, 0xAA, 0x55])
+
+CMD_HELLO = 0x06
+CMD_AUTH = 0x65
+CMD_CONTROL = 0x6A
+
+RM_SEND = 0x02
+RM_ENTER_LEARNING = 0x03
+RM_CHECK_DATA = 0x04
+RM_SENSORS = (0x01, 0x24)
+
+ERR_NOT_SUPPORTED = -4
+ERR_READ = -10
+
+# Device types python-broadlink handles with its rm4 class, which prefix every
+# control payload with a 2 byte header
+RM4_DEVTYPES = {0x51DA, 0x5F36, 0x6026, 0x6070, 0x610E, 0x610F, 0x61A2, 0x62BC}
+
+
+def _checksum(data):
+    return sum(data, 0xBEAF) & 0xFFFF
+
+
+def _crypt(key, data, encrypt):
+    cipher = Cipher(algorithms.AES(key), modes.CBC(IV), backend=default_backend())
+    context = cipher.encryptor() if encrypt else cipher.decryptor()
+    return context.update(data) + context.finalize()
+
+
+def _pad(data):
+    return bytes(data) + bytes((16 - len(data)) % 16)
+
+
+class SimulatedRM(object):
+    # One blaster listening on its own UDP port. Packets are handled one at a
+    # time like on a real device, so concurrent clients queue behind each other.
+
+    def __init__(
+        self,
+        mac,
+        name,
+        host="127.0.0.1",
+        devtype=0x2737,
+        latency_ms=20,
+        jitter_ms=0,
+        loss=0,
+        offline=False,
+        learn_code=None,
+        learn_delay=1,
+        seed=None,
+    ):
+        self.mac = mac
+        self.name = name
+        self.devtype = devtype
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.loss = loss
+        self.offline = offline
+        self.learn_code = learn_code
+        self.learn_delay = learn_delay
+
+        self.header_size = 2 if devtype in RM4_DEVTYPES else 0
+        self.key = os.urandom(16)
+        self.device_id = os.urandom(4)
+        self.learning_since = None
+        self.auths = 0
+        self.sent = []
+        self.dropped = 0
+
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((host, 0))
+        self.host = self._sock.getsockname()
+        self._thread = None
+
+    @property
+    def mac_str(self):
+        return ":".join("%02x" % byte for byte in self.mac)
+
+    def start(self):
+        self._thread = Thread(target=self._serve, name="rm-" + self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._sock.close()
+
+    def reply_to_hello(self, address):
+        if self.offline:
+            return
+
+        response = bytearray(0x80)
+        response[0x34:0x36] = struct.pack("<H", self.devtype)
+        response[0x3A:0x40] = bytes(reversed(self.mac))
+        name = self.name.encode()[:0x3F]
+        response[0x40 : 0x40 + len(name)] = name
+        try:
+            self._sock.sendto(response, address)
+        except OSError:
+            pass
+
+    def _serve(self):
+        while True:
+            try:
+                packet, address = self._sock.recvfrom(4096)
+            except OSError:
+                return
+
+            with self._lock:
+                if self.offline or self._random.random() < self.loss:
+                    self.dropped += 1
+                    continue
+                delay = self.latency_ms + self._random.uniform(0, self.jitter_ms)
+
+            time.sleep(delay / 1000)
+            response = self._handle(packet)
+            if response:
+                try:
+                    self._sock.sendto(response, address)
+                except OSError:
+                    return
+
+    def _handle(self, packet):
+        if len(packet) < 0x38 or packet[:8] != MAGIC:
+            return None
+        checksum = packet[0x20] | packet[0x21] << 8
+        if (_checksum(packet) - packet[0x20] - packet[0x21]) & 0xFFFF != checksum:
+            return None
+
+        command = packet[0x26]
+        if command == CMD_AUTH:
+            with self._lock:
+                self.auths += 1
+            payload = self.device_id[::-1] + self.key
+            return self._response(packet, 0, _crypt(DEFAULT_KEY, _pad(payload), True))
+
+        if command != CMD_CONTROL:
+            return self._response(packet, ERR_NOT_SUPPORTED)
+
+        payload = _crypt(self.key, packet[0x38:], False)
+        header = payload[: self.header_size]
+        code = payload[self.header_size]
+
+        if code == RM_SEND:
+            # Codes are recorded with the zero padding added for encryption
+            with self._lock:
+                self.sent.append(payload[self.header_size + 4 :])
+            return self._response(packet, 0)
+        if code == RM_ENTER_LEARNING:
+            self.learning_since = time.monotonic()
+            return self._response(packet, 0)
+        if code == RM_CHECK_DATA:
+            learned = (
+                self.learn_code
+                and self.learning_since is not None
+                and time.monotonic() - self.learning_since >= self.learn_delay
+            )
+            if not learned:
+                return self._response(packet, ERR_READ)
+            self.learning_since = None
+            reply = header + bytes([code, 0, 0, 0]) + self.learn_code
+            return self._response(packet, 0, _crypt(self.key, _pad(reply), True))
+        if code in RM_SENSORS:
+            reply = header + bytes([code, 0, 0, 0]) + bytes([21, 5, 45, 0])
+            return self._response(packet, 0, _crypt(self.key, _pad(reply), True))
+        return self._response(packet, ERR_NOT_SUPPORTED)
+
+    def _response(self, packet, error, payload=b""):
+        response = bytearray(0x38)
+        response[:8] = MAGIC
+        response[0x22:0x24] = struct.pack("<h", error)
+        response[0x24:0x26] = struct.pack("<H", self.devtype)
+        response[0x26] = packet[0x26]
+        response[0x28:0x2A] = packet[0x28:0x2A]
+        response[0x2A:0x30] = bytes(reversed(self.mac))
+        response[0x30:0x34] = self.device_id[::-1]
+        response[0x34:0x36] = struct.pack("<H", _checksum(payload))
+        response += payload
+        response[0x20:0x22] = struct.pack("<H", _checksum(response))
+        return bytes(response)
+
+
+class RMSimulator(object):
+    # A set of simulated blasters plus the port discovery hellos are sent to.
+    # Every blaster answers a hello from its own socket, since the address the
+    # answer comes from is what the client records as the blaster's address.
+
+    def __init__(self, devices=1, host="127.0.0.1", discovery_port=0, **options):
+        offline = options.pop("offline", 0)
+        seed = options.pop("seed", None)
+
+        self.devices = [
+            SimulatedRM(
+                mac=bytes([0x02, 0x00, 0x00, 0x00, index >> 8, index & 0xFF]),
+                name="sim" + str(index),
+                host=host,
+                offline=index >= devices - offline,
+                seed=None if seed is None else seed + index,
+                **options
+            )
+            for index in range(devices)
+        ]
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((host, discovery_port))
+        self.discovery_address = self._sock.getsockname()
+
+    def start(self):
+        for device in self.devices:
+            device.start()
+        Thread(target=self._serve_discovery, name="rm-discovery", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._sock.close()
+        for device in self.devices:
+            device.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _serve_discovery(self):
+        while True:
+            try:
+                packet, address = self._sock.recvfrom(1024)
+            except OSError:
+                return
+            if len(packet) >= 0x30 and packet[0x26] == CMD_HELLO:
+                for device in self.devices:
+                    device.reply_to_hello(address)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=2)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--discovery-port", type=int, default=0)
+    parser.add_argument(
+        "--devtype",
+        type=lambda value: int(value, 0),
+        default=0x2737,
+        help="device type reported to discovery (default 0x2737, RM mini 3)",
+    )
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument(
+        "--loss", type=float, default=0, help="fraction of packets dropped"
+    )
+    parser.add_argument(
+        "--offline", type=int, default=0, help="number of devices that never answer"
+    )
+    parser.add_argument(
+        "--learn-code", help="base64 code returned to learning requests"
+    )
+    parser.add_argument(
+        "--learn-delay",
+        type=float,
+        default=1,
+        help="seconds in learning mode before the code is captured",
+    )
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    simulator = RMSimulator(
+        devices=args.devices,
+        host=args.host,
+        discovery_port=args.discovery_port,
+        devtype=args.devtype,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        loss=args.loss,
+        offline=args.offline,
+        learn_code=base64.b64decode(args.learn_code) if args.learn_code else None,
+        learn_delay=args.learn_delay,
+        seed=args.seed,
+    )
+
+    with simulator:
+        for device in simulator.devices:
+            print(
+                "%s  %s  %s:%s%s"
+                % (
+                    device.name,
+                    device.mac_str,
+                    device.host[0],
+                    device.host[1],
+                    "  (offline)" if device.offline else "",
+                )
+            )
+        print("BROADLINK_DISCOVERY_ADDRESS=" + simulator.discovery_address[0])
+        print("BROADLINK_DISCOVERY_PORT=" + str(simulator.discovery_address[1]))
+        print("Running, press Ctrl+C to stop", flush=True)
+
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            pass
+
+    for device in simulator.devices:
+        print("%s: %d auths, %d sends" % (device.name, device.auths, len(device.sent)))
+
+
+if __name__ == "__main__":
+    main()
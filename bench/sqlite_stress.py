@@ -0,0 +1,218 @@
+"""Stress tests the app's SQLite DBs with concurrent worker processes.
+
+Starts --workers processes on a fresh set of DBs in a temporary directory, like
+gunicorn workers sharing one data directory, and has each of them run a mix of
+reads and short writes for --duration seconds:
+
+    python bench/sqlite_stress.py --workers 8 --duration 10 --write-fraction 0.3
+
+Writes rename blasters, upsert discovered blasters, save commands and start
+and finish learning jobs; reads fetch cached commands, pages of blasters,
+targets and commands, and events. The BROADLINK_SQLITE_* settings are applied
+as usual, so e.g. BROADLINK_SQLITE_JOURNAL_MODE=delete shows the old behaviour.
+Exits with status 1 if any operation failed with "database is locked".
+"""
+
+import argparse
+from collections import namedtuple
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app")
+
+# A short but valid IR code in the Broadlink format, base64 encoded
+STRESS_CODE = "JgAcAB0dHB44HhweGx4cHR06HB0cHhwdHB8bHhwADQUAAAAAAAAAAAAAAAA="
+BLASTERS = 20
+COMMANDS = 50
+
+# Stands in for a broadlink device found by discovery
+FoundDevice = namedtuple("FoundDevice", ["host", "mac", "devtype"])
+
+
+class NoThread(object):
+    # Stands in for the thread of a learning job, since capturing a code needs
+    # a real blaster, so jobs only touch the DB
+    def __init__(self, **kwargs):
+        pass
+
+    def start(self):
+        pass
+
+
+class LockErrorCounter(logging.Handler):
+    # Counts lock errors that the app logs instead of raising (e.g. events)
+    def __init__(self, counts):
+        super().__init__(logging.ERROR)
+        self.counts = counts
+
+    def emit(self, record):
+        if record.exc_info and "locked" in str(record.exc_info[1]):
+            self.counts["locked"] += 1
+
+
+def load_db_helpers(directory):
+    os.chdir(directory)
+    sys.path.insert(0, os.path.abspath(APP_DIR))
+
+    from db_helpers import blaster_db, command_db, event_db, learning_db, migrations
+
+    return blaster_db, command_db, event_db, learning_db, migrations
+
+
+def set_up(directory):
+    blaster_db, command_db, _, _, migrations = load_db_helpers(directory)
+    migrations.init_databases()
+
+    for index in range(BLASTERS):
+        blaster_db.Blaster.create(
+            ip="10.0.0." + str(index),
+            port=80,
+            devtype=0x2737,
+            mac="02:00:00:00:00:%02x" % index,
+            mac_hex="0200000000%02x" % index,
+            name="blaster" + str(index),
+        )
+    command_db.add_target("stress")
+    target = command_db.get_target("stress")
+    for index in range(COMMANDS):
+        target.put_command("command" + str(index), STRESS_CODE)
+
+
+def run_worker(number, directory, duration, write_fraction, seed, results):
+    from peewee import DatabaseError
+
+    blaster_db, command_db, event_db, learning_db, _ = load_db_helpers(directory)
+    rng = random.Random(seed + number)
+    counts = {"reads": 0, "writes": 0, "locked": 0, "errors": 0}
+    latencies = []
+
+    logging.getLogger().addHandler(LockErrorCounter(counts))
+    learning_db.Thread = NoThread
+
+    def find_device(timeout):
+        index = rng.randrange(BLASTERS)
+        return [
+            FoundDevice(
+                host=("10.%d.0.%d" % (number, index), 80),
+                mac=bytes([2, 0, 0, 0, 0, index]),
+                devtype=0x2737,
+            )
+        ]
+
+    blaster_db.discover_blasters = find_device
+
+    def rename_blaster():
+        blaster = blaster_db.Blaster.get_by_id(rng.randrange(BLASTERS) + 1)
+        blaster.name = "blaster%d-%d-%d" % (blaster.uid, number, counts["writes"])
+        blaster.save()
+
+    def discover():
+        blaster_db.get_new_blasters(timeout=0)
+
+    def save_command():
+        target = command_db.get_target("stress")
+        target.put_command("command" + str(rng.randrange(COMMANDS)), STRESS_CODE)
+
+    def learn():
+        blaster = blaster_db.Blaster.get_by_id(rng.randrange(BLASTERS) + 1)
+        job = learning_db.start_job(blaster, "stress", "learned" + str(number))
+        if job:
+            learning_db._finish_job(job.job_id, learning_db.TIMED_OUT)
+
+    def read():
+        choice = rng.randrange(4)
+        if choice == 0:
+            command_db.get_cached_command(
+                "stress", "command" + str(rng.randrange(COMMANDS))
+            )
+        elif choice == 1:
+            blaster_db.get_blasters_page(limit=10, after=rng.randrange(BLASTERS))
+        elif choice == 2:
+            command_db.get_target("stress").get_commands_page(
+                ("name",), limit=20, after=rng.randrange(COMMANDS)
+            )
+        else:
+            event_db.get_events(rng.randrange(100), limit=20)
+
+    writes = [rename_blaster, discover, save_command, learn]
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        write = rng.random() < write_fraction
+        start = time.perf_counter()
+        try:
+            if write:
+                rng.choice(writes)()
+            else:
+                read()
+            counts["writes" if write else "reads"] += 1
+        except DatabaseError as err:
+            counts["locked" if "locked" in str(err) else "errors"] += 1
+        latencies.append(time.perf_counter() - start)
+
+    counts["p99_ms"] = sorted(latencies)[int(len(latencies) * 0.99)] * 1000
+    results.put(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--write-fraction", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="broadlink-stress-")
+    os.makedirs(os.path.join(directory, "data"))
+
+    # Workers are spawned rather than forked so none inherits an open connection
+    context = multiprocessing.get_context("spawn")
+    setup = context.Process(target=set_up, args=(directory,))
+    setup.start()
+    setup.join()
+
+    results = context.Queue()
+    workers = [
+        context.Process(
+            target=run_worker,
+            args=(
+                number,
+                directory,
+                args.duration,
+                args.write_fraction,
+                args.seed,
+                results,
+            ),
+        )
+        for number in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    totals = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    print(
+        "%d workers, %d reads, %d writes, %d locked, %d other errors, "
+        "worst p99 %.1f ms"
+        % (
+            args.workers,
+            sum(counts["reads"] for counts in totals),
+            sum(counts["writes"] for counts in totals),
+            sum(counts["locked"] for counts in totals),
+            sum(counts["errors"] for counts in totals),
+            max(counts["p99_ms"] for counts in totals),
+        )
+    )
+    print("DBs left in " + directory)
+
+    if any(counts["locked"] for counts in totals):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
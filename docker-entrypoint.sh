@@ -1,4 +1,23 @@
 #!/bin/bash
 set -e
 
-gunicorn --bind=${HOST}:${PORT} app:app
+# workers write their metrics here so /metrics can add them up; start clean
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}"
+rm -rf "${PROMETHEUS_MULTIPROC_DIR}"
+mkdir -p "${PROMETHEUS_MULTIPROC_DIR}"
+
+# apply DB migrations once before the workers start
+python -m db_helpers.migrations
+
+# one broker process owns the blaster connections for all workers
+if [ -n "${BROADLINK_BROKER_SOCKET}" ]; then
+    python -m db_helpers.device_broker &
+fi
+
+if [ "${SERVER_MODE}" = "asgi" ]; then
+    uvicorn --host=${HOST} --port=${PORT} asgi:app
+else
+    # threads let /events streams and long polls wait without blocking the worker
+    gunicorn --worker-class=gthread --threads=${BROADLINK_WSGI_THREADS:-32} \
+        --bind=${HOST}:${PORT} app:app
+fi